@@ -1,16 +1,24 @@
 from __future__ import division, unicode_literals
 
+import difflib
+import itertools
 import os
 import hashlib
+import heapq
 import logging
+import multiprocessing
 import re
+import threading
+import time
 
 from datetime import datetime
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from .bencode import bencode, bdecode
+from .fileops import copy_range, pad_zeros, reflink, resize_clone
 from .humanize import humanize_bytes
-from .utils import is_unsplitable, get_root_of_unsplitable, Pieces
+from .utils import is_unsplitable, get_root_of_unsplitable, verify_pieces, Pieces
 
 logger = logging.getLogger('autotorrent')
 
@@ -46,17 +54,75 @@ status_messages = {
   Status.FAILED_TO_ADD_TO_CLIENT: '%sFAILED%s' % (COLOR_FAILED_TO_ADD_TO_CLIENT, Color.ENDC),
 }
 
-CHUNK_SIZE = 65536
-
 class UnknownLinkTypeException(Exception):
     pass
 
 class IllegalPathException(Exception):
     pass
 
+_index_worker = None
+
+def _init_index_worker(db, settings, torrents_seeded, cached_info_hashes, is_new):
+    """
+    Sets up a pool process to index torrents, see AutoTorrent.handle_torrentfiles.
+    settings are the attributes of the AutoTorrent used for indexing, see AutoTorrent.get_index_settings.
+    """
+    global _index_worker
+    db.open(read_only=True)
+    at = AutoTorrent(db, None, None, 0, 0, False)
+    for name, value in settings.items():
+        setattr(at, name, value)
+    
+    if at.piece_hash_cache is not None:
+        at.piece_hash_cache.open(read_only=True)
+    
+    at.torrents_seeded = torrents_seeded
+    _index_worker = (at, cached_info_hashes, is_new)
+
+def _index_torrentfile(path):
+    """
+    Opens and indexes a torrentfile in a pool process, torrents already seeded or
+    with a cached index result are not indexed.
+    
+    Returns (torrent, info hash, index result, new piece hashes), the index result is the exception
+    if anything failed. The new piece hashes must be added to the piece hash cache by the caller.
+    """
+    at, cached_info_hashes, is_new = _index_worker
+    new_hashes = {}
+    try:
+        torrent = at.open_torrentfile(path)
+        info_hash = at.get_info_hash(torrent)
+        files = None
+        if info_hash not in cached_info_hashes and (is_new or not at.check_torrent_in_client(torrent, info_hash)):
+            files = at.index_torrent(torrent)
+    except Exception as e:
+        torrent, info_hash, files = None, None, e
+    
+    if at.piece_hash_cache is not None:
+        new_hashes = at.piece_hash_cache.pop_new_hashes()
+    
+    return torrent, info_hash, files, new_hashes
+
 class AutoTorrent(object):
-    def __init__(self, db, client, store_path, add_limit_size, add_limit_percent, delete_torrents, link_type='soft'):
+    index_batch_size = 500 # number of torrents indexed together by handle_torrentfiles
+    hash_check_workers = 4 # number of candidate files hash checked at the same time
+    hash_check_device_workers = 1 # number of candidate files hash checked at the same time on one device
+    hash_check_max_candidates = 10 # max number of candidate files hash checked for a file
+    hash_check_shortlist_factor = 4 # candidates stat'ed and compared by name for every candidate hash checked
+    hash_check_max_combinations = 16 # max number of combinations of candidate files tried for a piece shared by files
+    index_settings = ['hash_check_workers', 'hash_check_device_workers', 'hash_check_max_candidates',
+                      'hash_check_max_combinations', 'piece_hash_cache'] # see get_index_settings
+    link_workers = 8 # number of links made at the same time
+    link_folders = False # soft link whole folders found complete on disk instead of each file in them
+    sparse_padding = True # leave the data added to rewritten files as holes instead of writing zeros
+    
+    def __init__(self, db, client, store_path, add_limit_size, add_limit_percent, delete_torrents, link_type='soft',
+                 match_cache=None, verify=False, verify_jobs=1, piece_hash_cache=None):
         self.db = db
+        self.match_cache = match_cache
+        self.piece_hash_cache = piece_hash_cache
+        self.verify = verify
+        self.verify_jobs = verify_jobs
         self.client = client
         self.store_path = store_path
         self.add_limit_size = add_limit_size
@@ -108,7 +174,7 @@ class AutoTorrent(object):
         Uses hash checking to find pieces
         """
         modified_result = False
-        pieces = Pieces(torrent)
+        pieces = Pieces(torrent, self.piece_hash_cache)
         
         if self.db.hash_slow_mode:
             logger.info('Slow mode enabled, building hash size table')
@@ -116,8 +182,9 @@ class AutoTorrent(object):
         
         start_size = 0
         end_size = 0
+        boundary_candidates = {}
         logger.info('Hash scan mode enabled, checking for incomplete files')
-        for f in result:
+        for i, f in enumerate(result):
             start_size = end_size
             end_size += f['length']
             
@@ -127,7 +194,7 @@ class AutoTorrent(object):
             files_to_check = []
             logger.debug('Building list of file names to match hash with.')
             
-            if self.db.hash_size_mode:
+            if self.db.hash_size_mode and self.db.has_size(f['length']):
                 logger.debug('Using hash size mode to find files')
                 files_to_check += self.db.find_hash_size(f['length'])
             
@@ -142,50 +209,364 @@ class AutoTorrent(object):
             
             logger.debug('Found %i files to check for matching hash' % len(files_to_check))
             
-            checked_files = set()
-            for db_file in files_to_check:
-                if db_file in checked_files:
-                    logger.debug('File %s already checked, skipping' % db_file)
+            files_to_check = self.plan_candidates(f, files_to_check)
+            if not pieces.get_complete_pieces(start_size, end_size)[2]:
+                logger.debug('File has no whole pieces, checking it with the pieces shared with other files later')
+                boundary_candidates[i] = files_to_check
+                continue
+            
+            match = self.check_candidates(pieces, files_to_check, start_size, end_size)
+            if match:
+                db_file, match_start, match_end = match
+                size = os.path.getsize(db_file)
+                if size != f['length']: # size does not match, need to align file
+                    logger.debug('File does not have correct size, need to align it')
+                    if match_start and match_end:
+                        logger.debug('Need to find alignment in the middle of the file')
+                        modification_point = pieces.find_piece_breakpoint(db_file, start_size, end_size)
+                    elif match_start:
+                        logger.debug('Need to modify from the end of the file')
+                        modification_point = min(f['length'], size)
+                    elif match_end:
+                        logger.debug('Need to modify at the front of the file')
+                        modification_point = 0
+                    
+                    if size > f['length']:
+                        modification_action = 'remove'
+                    else:
+                        modification_action = 'add'
+                    
+                    f['completed'] = False
+                    f['postprocessing'] = ('rewrite', modification_action, modification_point)
+                    modified_result = True
+                else:
+                    logger.debug('Perfect size, perfect match !')
+                    f['completed'] = True
+                
+                f['actual_path'] = db_file
+        
+        if boundary_candidates:
+            self.match_boundary_pieces(pieces, result, boundary_candidates)
+        
+        return modified_result, result
+    
+    def match_boundary_pieces(self, pieces, result, candidates):
+        """
+        Hash checks files without whole pieces of their own, e.g. small files, using the pieces
+        they share with the files next to them. The other files in a piece must be found already
+        or be checked at the same time, at most hash_check_max_combinations combinations of
+        candidates are tried for a piece.
+        
+        candidates is a dict of index in result to candidate files.
+        """
+        lengths = [f['length'] for f in result]
+        offsets = [0]
+        for length in lengths:
+            offsets.append(offsets[-1] + length)
+        
+        exact_candidates = {}
+        for i, file_candidates in candidates.items():
+            exact_candidates[i] = []
+            for db_file in file_candidates:
+                try:
+                    if os.path.getsize(db_file) == lengths[i]:
+                        exact_candidates[i].append(db_file)
+                except OSError:
+                    continue
+        
+        def piece_options(piece_index, i, db_file):
+            options = []
+            for file_index, offset, length in pieces.get_piece_parts(piece_index, offsets):
+                f = result[file_index]
+                if file_index == i:
+                    choices = [db_file]
+                elif f['completed'] and not f.get('postprocessing'):
+                    choices = [f['actual_path']]
+                else:
+                    choices = exact_candidates.get(file_index, [])
+                options.append([(file_index, choice, offset, length) for choice in choices])
+            return options
+        
+        def piece_range(i):
+            return offsets[i] // pieces.piece_size, (offsets[i+1] - 1) // pieces.piece_size
+        
+        queue = sorted(exact_candidates)
+        queued = set(queue)
+        while queue: # files found can make it possible to check their neighbors, they are checked again
+            i = heapq.heappop(queue)
+            queued.discard(i)
+            f = result[i]
+            if f['completed'] or not f['length']:
+                continue
+            
+            first_piece, last_piece = piece_range(i)
+            for db_file in exact_candidates[i]:
+                matched_parts = []
+                for piece_index in range(first_piece, last_piece + 1):
+                    combinations = itertools.islice(itertools.product(*piece_options(piece_index, i, db_file)),
+                                                    self.hash_check_max_combinations)
+                    for parts in combinations:
+                        if pieces.match_piece(piece_index, [(choice, offset, length) for _, choice, offset, length in parts]):
+                            matched_parts += parts
+                            break
+                    else:
+                        break
+                else:
+                    logger.info('File %s matched using the pieces shared with other files' % db_file)
+                    found_indexes = []
+                    for file_index, choice, _, _ in matched_parts:
+                        if not result[file_index]['completed']:
+                            result[file_index]['completed'] = True
+                            result[file_index]['actual_path'] = choice
+                            found_indexes.append(file_index)
+                    
+                    for found_index in found_indexes:
+                        for piece_index in set(piece_range(found_index)):
+                            for file_index, _, _ in pieces.get_piece_parts(piece_index, offsets):
+                                if file_index in exact_candidates and file_index not in queued and not result[file_index]['completed']:
+                                    heapq.heappush(queue, file_index)
+                                    queued.add(file_index)
+                    break
+
+    def plan_candidates(self, f, candidates):
+        """
+        Orders the candidate files for a file in the torrent by how likely they are to match.
+        
+        The candidates are expected with the ones found by size first, ordered by how close
+        their size is. Only a shortlist of the candidates with the same name and the first ones
+        is looked at, hash_check_shortlist_factor for every candidate returned.
+        
+        Candidates with the exact size come first, then the ones with the most similar name and
+        then the ones closest in size. The same file found by path or by inode is only kept once,
+        candidates that are gone are dropped and at most hash_check_max_candidates are returned.
+        """
+        name = self.db.normalize_filename(f['path'][-1])
+        seen_paths = set()
+        shortlist = []
+        for i, db_file in enumerate(candidates):
+            if db_file in seen_paths:
+                logger.debug('File %s already checked, skipping' % db_file)
+                continue
+            seen_paths.add(db_file)
+            db_name = self.db.normalize_filename(os.path.basename(db_file))
+            shortlist.append((db_name != name, i, db_file, db_name))
+        
+        shortlist_size = self.hash_check_max_candidates * self.hash_check_shortlist_factor
+        if len(shortlist) > shortlist_size:
+            logger.debug('Only looking at %i of %i candidates' % (shortlist_size, len(shortlist)))
+            shortlist = sorted(shortlist)[:shortlist_size]
+        
+        ranked = []
+        for _, i, db_file, db_name in shortlist:
+            try:
+                stat = os.stat(db_file)
+            except OSError:
+                logger.debug('File %s is gone, skipping' % db_file)
+                continue
+            
+            similarity = difflib.SequenceMatcher(None, name, db_name).ratio()
+            ranked.append((stat.st_size != f['length'], -similarity, abs(stat.st_size - f['length']), i,
+                           db_file, (stat.st_dev, stat.st_ino)))
+        ranked.sort()
+        
+        seen_inodes = set()
+        result = []
+        for _, _, _, _, db_file, inode in ranked:
+            if inode in seen_inodes:
+                logger.debug('File %s is a link to a file already checked, skipping' % db_file)
+                continue
+            seen_inodes.add(inode)
+            result.append(db_file)
+        
+        if len(result) > self.hash_check_max_candidates:
+            logger.debug('Only checking the best %i of %i candidates' % (self.hash_check_max_candidates, len(result)))
+        
+        return result[:self.hash_check_max_candidates]
+    
+    def check_candidates(self, pieces, candidates, start_size, end_size):
+        """
+        Hash checks candidate files for a file in the torrent.
+        
+        Up to hash_check_workers candidates are checked at the same time and at most
+        hash_check_device_workers of them on the same device. Candidates after a match are not checked.
+        
+        Returns (path, match_start, match_end) of the first candidate that matched, None if none did.
+        """
+        found = [len(candidates)] # index of the first candidate known to match
+        lock = threading.Lock()
+        device_semaphores = {}
+        
+        def check(i):
+            db_file = candidates[i]
+            if found[0] < i:
+                return False, False
+            
+            try:
+                device = os.stat(db_file).st_dev
+            except OSError:
+                logger.warning('Unable to hash check %s, it is gone' % db_file)
+                return False, False
+            
+            with lock:
+                if device not in device_semaphores:
+                    device_semaphores[device] = threading.Semaphore(self.hash_check_device_workers)
+                semaphore = device_semaphores[device]
+            
+            with semaphore:
+                if found[0] < i:
+                    return False, False
                 
-                checked_files.add(db_file)
                 logger.info('Hash checking %s' % db_file)
-                match_start, match_end = pieces.match_file(db_file, start_size, end_size)
+                try:
+                    match_start, match_end = pieces.match_file(db_file, start_size, end_size)
+                except (IOError, OSError):
+                    logger.warning('Unable to hash check %s, failed to read it' % db_file)
+                    return False, False
                 logger.info('We go result for file %s start:%s end:%s' % (db_file, match_start, match_end))
+            
+            if match_start or match_end:
+                with lock:
+                    found[0] = min(found[0], i)
+            return match_start, match_end
+        
+        if self.hash_check_workers > 1 and len(candidates) > 1:
+            pool = ThreadPool(min(self.hash_check_workers, len(candidates)))
+            try:
+                results = [pool.apply_async(check, (i, )) for i in range(len(candidates))]
+                for i, result in enumerate(results):
+                    match_start, match_end = result.get()
+                    if match_start or match_end:
+                        return candidates[i], match_start, match_end
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for i in range(len(candidates)):
+                match_start, match_end = check(i)
+                if match_start or match_end:
+                    return candidates[i], match_start, match_end
+        
+        return None
+    
+    def find_folder_match(self, torrent_files):
+        """
+        Looks for a folder with the same files as the torrent using the folder signature index.
+        The folder may have another name than the torrent.
+        
+        Returns the files with actual paths if a folder was found, otherwise None.
+        """
+        signature = self.db.folder_signature((f['path'], f['length']) for f in torrent_files)
+        for folder in self.db.find_folder_path(signature):
+            logger.debug('Checking folder %r with matching signature' % folder)
+            result = []
+            for f in torrent_files:
+                p = os.path.join(folder, *f['path'])
+                if not os.path.isfile(p) or os.path.getsize(p) != f['length']:
+                    logger.debug('File %r did not match, folder has changed' % p)
+                    break
                 
-                if match_start or match_end: # this file is all-good
-                    size = os.path.getsize(db_file)
-                    if size != f['length']: # size does not match, need to align file
-                        logger.debug('File does not have correct size, need to align it')
-                        if match_start and match_end:
-                            logger.debug('Need to find alignment in the middle of the file')
-                            modification_point = pieces.find_piece_breakpoint(db_file, start_size, end_size)
-                        elif match_start:
-                            logger.debug('Need to modify from the end of the file')
-                            modification_point = min(f['length'], size)
-                        elif match_end:
-                            logger.debug('Need to modify at the front of the file')
-                            modification_point = 0
-                        
-                        if size > f['length']:
-                            modification_action = 'remove'
-                        else:
-                            modification_action = 'add'
-                        
-                        f['completed'] = False
-                        f['postprocessing'] = ('rewrite', modification_action, modification_point)
-                        modified_result = True
-                    else:
-                        logger.debug('Perfect size, perfect match !')
-                        f['completed'] = True
+                result.append(dict(f, actual_path=p, completed=True))
+            else:
+                logger.info('Found all files in folder %r' % folder)
+                return result
+        
+        return None
+    
+    def get_file_lookups(self, torrent):
+        """
+        Finds the database lookups needed to index the files in the torrent.
+        
+        Returns a list of (file, lookup) in torrent order, lookup being a (method name, *args)
+        tuple for Database.find_many.
+        """
+        torrent_name = self.try_decode(torrent[b'info'][b'name'])
+        if b'files' not in torrent[b'info']: # singlefile torrent
+            f = {'path': [torrent_name], 'length': torrent[b'info'][b'length']}
+            return [(f, ('find_file_path', torrent_name, f['length']))]
+        
+        files = []
+        path_files = defaultdict(list)
+        for f in torrent[b'info'][b'files']:
+            logger.debug('Handling torrent file %r' % (f, ))
+            orig_path = [self.try_decode(x) for x in f[b'path'] if x] # remove empty fragments
+            if not self.is_legal_path(orig_path):
+                raise IllegalPathException('That is a dangerous torrent path %r, bailing' % orig_path)
+            
+            f = {'path': orig_path, 'length': f[b'length']}
+            path = os.path.join(*([torrent_name] + orig_path[:-1]))
+            path_files[path].append(f)
+            files.append((path, f))
+        
+        unsplitable_names = {}
+        if self.db.unsplitable_mode:
+            unsplitable_paths = set()
+            for path, path_file_list in path_files.items():
+                if is_unsplitable(f['path'][-1] for f in path_file_list):
+                    path = path.split(os.sep)
+                    name = get_root_of_unsplitable(path)
+                    if not name:
+                        continue
                     
-                    f['actual_path'] = db_file
-                    break
+                    while path[-1] != name:
+                        path.pop()
+                    unsplitable_paths.add(os.path.join(*path))
+            
+            for path in path_files:
+                path = path.split(os.sep)
+                while path and os.path.join(*path) not in unsplitable_paths:
+                    path.pop()
+                
+                if path:
+                    unsplitable_names[os.path.join(*path)] = path[-1]
         
-        return modified_result, result
-
-    def index_torrent(self, torrent):
+        file_lookups = []
+        for path, f in files:
+            path = path.split(os.sep)
+            while path and os.path.join(*path) not in unsplitable_names:
+                path.pop()
+            
+            if path:
+                lookup = ('find_unsplitable_file_path', unsplitable_names[os.path.join(*path)], tuple(f['path']), f['length'])
+            else:
+                lookup = ('find_file_path', f['path'][-1], f['length'])
+            file_lookups.append((f, lookup))
+        
+        return file_lookups
+    
+    def index_torrents(self, torrents):
+        """
+        Indexes the files in many torrents, see index_torrent.
+        
+        The name and size lookups of all the torrents are collected first and done
+        at once, so every unique lookup is only done once.
+        
+        Returns a list of index results, or the exception raised while indexing a torrent.
+        """
+        lookups = set()
+        for torrent in torrents:
+            try:
+                lookups.update(lookup for f, lookup in self.get_file_lookups(torrent))
+            except IllegalPathException:
+                pass # raised again when indexing
+        
+        lookups = list(lookups)
+        logger.debug('Looking up %i unique files for %i torrents' % (len(lookups), len(torrents)))
+        found = dict(zip(lookups, self.db.find_many(lookups)))
+        
+        result = []
+        for torrent in torrents:
+            try:
+                result.append(self.index_torrent(torrent, found))
+            except IllegalPathException as e:
+                result.append(e)
+        
+        return result
+    
+    def index_torrent(self, torrent, found=None):
         """
         Indexes the files in the torrent.
+        
+        found is an optional dict with the results of lookups already done, see index_torrents.
         """
         torrent_name = torrent[b'info'][b'name']
         logger.debug('Handling torrent name %r' % (torrent_name, ))
@@ -244,78 +625,23 @@ class AutoTorrent(object):
                                     'files': result}
         
         
+        file_lookups = self.get_file_lookups(torrent)
+        
+        if b'files' in torrent[b'info'] and (self.db.normal_mode or self.db.unsplitable_mode):
+            folder_result = self.find_folder_match([f for f, lookup in file_lookups])
+            if folder_result:
+                return {'mode': 'link', 'files': folder_result}
+        
+        lookups = [lookup for f, lookup in file_lookups]
+        if found is None or any(lookup not in found for lookup in lookups):
+            found = dict(zip(lookups, self.db.find_many(lookups)))
+        
         result = []
-        if b'files' in torrent[b'info']: # multifile torrent
-            files_sorted = {}
-            files = {}
-            if b'files' in torrent[b'info']:
-                
-                i = 0
-                path_files = defaultdict(list)
-                for f in torrent[b'info'][b'files']:
-                    logger.debug('Handling torrent file %r' % (f, ))
-                    orig_path = [self.try_decode(x) for x in f[b'path'] if x] # remove empty fragments
-                    if not self.is_legal_path(orig_path):
-                        raise IllegalPathException('That is a dangerous torrent path %r, bailing' % orig_path)
-                    
-                    path = [torrent_name] + orig_path
-                    name = path.pop()
-                    
-                    path_files[os.path.join(*path)].append({
-                        'path': orig_path,
-                        'length': f[b'length'],
-                    })
-                    
-                    files_sorted['/'.join(orig_path)] = i
-                    i += 1
-            
-            if self.db.unsplitable_mode:
-                unsplitable_paths = set()
-                for path, files in path_files.items():
-                    if is_unsplitable(f['path'][-1] for f in files):
-                        path = path.split(os.sep)
-                        name = get_root_of_unsplitable(path)
-                        if not name:
-                            continue
-                        
-                        while path[-1] != name:
-                            path.pop()
-                        unsplitable_paths.add(os.path.join(*path))
-            
-            for path, files in path_files.items():
-                if self.db.unsplitable_mode:
-                    path = path.split(os.sep)
-                    while path and os.path.join(*path) not in unsplitable_paths:
-                        path.pop()
-                else:
-                    path = None
-                
-                if path:
-                    name = path[-1]
-                    for f in files:
-                        actual_path = self.db.find_unsplitable_file_path(name, f['path'], f['length'])
-                        f['actual_path'] = actual_path
-                        f['completed'] = actual_path is not None
-                    result += files
-                else:
-                    for f in files:
-                        actual_path = self.db.find_file_path(f['path'][-1], f['length'])
-                        f['actual_path'] = actual_path
-                        f['completed'] = actual_path is not None
-                    result += files
-            # re-sort the torrent to fit original ordering
-            result = sorted(result, key=lambda x:files_sorted['/'.join(x['path'])])
-            
-        else: # singlefile torrent
-            length = torrent[b'info'][b'length']
-            actual_path = self.db.find_file_path(torrent_name, length)
-            
-            result.append({
-                'actual_path': actual_path,
-                'length': length,
-                'path': [torrent_name],
-                'completed': actual_path is not None,
-            })
+        for f, lookup in file_lookups:
+            actual_path = found[lookup]
+            f['actual_path'] = actual_path
+            f['completed'] = actual_path is not None
+            result.append(f)
         
         mode = 'link'
         if self.db.hash_mode:
@@ -325,12 +651,13 @@ class AutoTorrent(object):
         
         return {'mode': mode, 'files': result}
 
-    def parse_torrent(self, torrent):
+    def parse_torrent(self, torrent, files=None):
         """
         Parses the torrent and finds the physical location of files
-        in the torrent
+        in the torrent, files can be passed if the torrent is already indexed
         """
-        files = self.index_torrent(torrent)
+        if files is None:
+            files = self.index_torrent(torrent)
 
         found_size, missing_size = 0, 0
         for f in files['files']:
@@ -344,27 +671,139 @@ class AutoTorrent(object):
     def link_files(self, destination_path, files):
         """
         Links the files to the destination_path if they are found.
+        The folders are created first, then up to link_workers links are made at the same time.
+        
+        With soft links and link_folders enabled, folders found complete on disk are linked
+        instead of the files in them, see find_folder_links.
         """
-        if not os.path.isdir(destination_path):
-            os.makedirs(destination_path)
+        folder_links = {}
+        if self.link_type == 'soft' and self.link_folders:
+            folder_links = self.find_folder_links(files)
+        
+        links = [(source, os.path.join(destination_path, *folder)) for folder, source in folder_links.items()]
+        links += [(f['actual_path'], os.path.join(destination_path, *f['path'])) for f in files
+                  if f['completed'] and not any(tuple(f['path'][:i]) in folder_links for i in range(1, len(f['path'])))]
+        
+        folders = set([destination_path])
+        folders.update(os.path.dirname(destination) for _, destination in links)
+        for folder in sorted(folders):
+            if not os.path.isdir(folder):
+                logger.debug('Folder %r does not exist, creating' % folder)
+                os.makedirs(folder)
         
+        start_time = time.time()
+        if self.link_workers > 1 and len(links) > 1:
+            pool = ThreadPool(min(self.link_workers, len(links)))
+            try:
+                pool.map(lambda link: self.link_file(*link), links)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for source, destination in links:
+                self.link_file(source, destination)
+        
+        elapsed = time.time() - start_time
+        logger.info('Made %i links in %.2f seconds (%.0f links/sec)' % (len(links), elapsed, len(links) / max(elapsed, 1e-6)))
+    
+    def find_folder_links(self, files):
+        """
+        Finds the folders inside the torrent that can be linked as a whole. All files in such
+        a folder must be found with the same relative paths inside one folder on disk
+        and that folder must contain nothing else. The torrent root is never linked.
+        
+        Returns a dict of folder path in the torrent (tuple) to folder on disk, only the outermost folders are included.
+        """
+        candidates = {} # folder path in the torrent -> folder on disk, None if it cannot be linked
+        expected_files = defaultdict(set) # folder path in the torrent -> relative paths of the files in it
         for f in files:
-            if f['completed']:
-                destination = os.path.join(destination_path, *f['path'])
+            for i in range(1, len(f['path'])):
+                folder = tuple(f['path'][:i])
+                if candidates.get(folder, '') is None:
+                    continue
                 
-                file_path = os.path.dirname(destination)
-                if not os.path.isdir(file_path):
-                    logger.debug('Folder %r does not exist, creating' % file_path)
-                    os.makedirs(file_path)
-    
-                logger.debug('Making %s link from %r to %r' % (self.link_type, f['actual_path'], destination))
+                relative_path = os.path.join(*f['path'][i:])
+                source = None
+                if f['completed'] and f['actual_path'].endswith(os.sep + relative_path):
+                    source = f['actual_path'][:-len(relative_path) - 1]
                 
-                if self.link_type == 'soft':
-                    os.symlink(f['actual_path'], destination)
-                elif self.link_type == 'hard':
-                    os.link(f['actual_path'], destination)
+                if candidates.setdefault(folder, source) != source:
+                    candidates[folder] = None
+                    expected_files.pop(folder, None)
                 else:
-                    raise UnknownLinkTypeException('%r is not a known link type' % self.link_type)
+                    expected_files[folder].add(relative_path)
+        
+        folder_links = {}
+        found_files = {} # folder on disk -> relative paths of the files in it, filled by walking the outermost folders
+        for folder in sorted(candidates, key=len):
+            source = candidates[folder]
+            if source is None or any(folder[:i] in folder_links for i in range(1, len(folder))):
+                continue
+            
+            if source not in found_files:
+                found_files.update(self.list_folder_tree(source))
+            
+            if found_files[source] == expected_files[folder]:
+                logger.debug('Folder %r is complete in %r, linking the folder' % (os.path.join(*folder), source))
+                folder_links[folder] = source
+        
+        return folder_links
+    
+    def list_folder_tree(self, source):
+        """
+        Lists the files and links inside a folder on disk with a single walk.
+        
+        Returns a dict of the folder and every folder below it to the relative paths of the files and links inside them.
+        """
+        found_files = {}
+        for root, dirs, filenames in os.walk(source):
+            relative_root = [] if root == source else os.path.relpath(root, source).split(os.sep)
+            parents = [(os.path.join(source, *relative_root[:i]), relative_root[i:]) for i in range(len(relative_root) + 1)]
+            found_files[root] = set()
+            
+            names = filenames + [name for name in dirs if os.path.islink(os.path.join(root, name))]
+            for name in names:
+                for parent, relative_parts in parents:
+                    found_files[parent].add(os.path.join(*(relative_parts + [name])))
+        
+        return found_files
+    
+    def link_file(self, source, destination):
+        """
+        Links source to destination with link_type.
+        
+        With the auto link type, files on the same device as the destination are hard linked,
+        or reflinked if that fails, and other files are symlinked.
+        """
+        link_type = self.link_type
+        if link_type == 'auto':
+            if os.stat(source).st_dev == os.stat(os.path.dirname(destination)).st_dev:
+                try:
+                    logger.debug('Making hard link from %r to %r' % (source, destination))
+                    os.link(source, destination)
+                    return
+                except OSError as e:
+                    logger.debug('Unable to hard link %r: %s' % (source, e))
+                
+                try:
+                    logger.debug('Making reflink from %r to %r' % (source, destination))
+                    reflink(source, destination)
+                    return
+                except (IOError, OSError) as e:
+                    logger.debug('Unable to reflink %r: %s' % (source, e))
+            
+            link_type = 'soft'
+        
+        logger.debug('Making %s link from %r to %r' % (link_type, source, destination))
+        
+        if link_type == 'soft':
+            os.symlink(source, destination)
+        elif link_type == 'hard':
+            os.link(source, destination)
+        elif link_type == 'reflink':
+            reflink(source, destination)
+        else:
+            raise UnknownLinkTypeException('%r is not a known link type' % link_type)
     
     def rewrite_hashed_files(self, destination_path, files):
         """
@@ -389,51 +828,158 @@ class AutoTorrent(object):
                 expected_size = f['length']
                 diff = abs(current_size - expected_size)
                 
-                # write until modification_point, do action, write rest of file
+                if (modification_action == 'remove' or self.sparse_padding) and \
+                   resize_clone(f['actual_path'], destination, modification_action, modification_point, diff):
+                    logger.debug('Rewrote file by cloning it and resizing it at the breakpoint')
+                    continue
+                
+                # copy until modification_point, do action, copy rest of file
+                if modification_action == 'remove':
+                    logger.debug('Have to shrink compared to original file, skipping %i bytes' % diff)
+                    rest_offset, rest_destination_offset = modification_point + diff, modification_point
+                else:
+                    rest_offset, rest_destination_offset = modification_point, modification_point + diff
                 
-                modified = False
-                bytes_written = 0
                 with open(destination, 'wb') as output_fp:
                     with open(f['actual_path'], 'rb') as input_fp:
                         logger.debug('Opened file %s and writing its data to %s - The breakpoint is %i' % (f['actual_path'], destination, modification_point))
-                        while True:
-                            if not modified and bytes_written == modification_point:
-                                logger.debug('Time to modify with action %s and bytes %i' % (modification_action, diff))
-                                modified = True
-                                if modification_action == 'remove':
-                                    seek_point = bytes_written + diff
-                                    logger.debug('Have to shrink compared to original file, seeking to %i' % (seek_point, ))
-                                    input_fp.seek(seek_point)
-                                elif modification_action == 'add':
-                                    logger.debug('Need to add data, writing %i empty bytes' % diff)
-                                    while diff > 0:
-                                        write_bytes = min(CHUNK_SIZE, diff)
-                                        output_fp.write(b'\x00' * write_bytes)
-                                        diff -= write_bytes
-                            
-                            read_bytes = CHUNK_SIZE
-                            if not modified:
-                                read_bytes = min(read_bytes, modification_point-bytes_written)
-                            
-                            logger.debug('Reading %i bytes' % (read_bytes, ))
-                            data = input_fp.read(read_bytes)
-                            if not data:
-                                break
-                            output_fp.write(data)
-                            bytes_written += read_bytes
+                        input_fd, output_fd = input_fp.fileno(), output_fp.fileno()
+                        copy_range(input_fd, output_fd, 0, 0, modification_point)
+                        if modification_action == 'add':
+                            logger.debug('Need to add data, padding with %i empty bytes' % diff)
+                            pad_zeros(output_fd, modification_point, diff, self.sparse_padding)
+                        copy_range(input_fd, output_fd, rest_offset, rest_destination_offset, current_size - rest_offset)
                 logger.debug('Done rewriting file')
     
+    def handle_torrentfiles(self, paths, dry_run=False, is_new=False, jobs=1):
+        """
+        Handles many torrentfiles, see handle_torrentfile.
+        The torrents are opened and indexed index_batch_size at a time with index_torrents.
+        
+        With more than one job, the torrents are opened and indexed by a pool of jobs processes
+        reading the database while this process links and adds them.
+        
+        Yields the result for each path in order.
+        """
+        if jobs > 1:
+            for result in self._handle_torrentfiles_pool(paths, dry_run, is_new, jobs):
+                yield result
+            return
+        
+        for i in range(0, len(paths), self.index_batch_size):
+            version = self.get_match_cache_version()
+            batch = []
+            for path in paths[i:i + self.index_batch_size]:
+                try:
+                    torrent = self.open_torrentfile(path)
+                    info_hash = self.get_info_hash(torrent)
+                except Exception as e: # raised when the torrent is handled, after the ones before it
+                    batch.append((path, None, None, e))
+                    continue
+                batch.append((path, torrent, info_hash, self.get_cached_index(info_hash, version)))
+            
+            to_index = [(path, torrent, info_hash) for path, torrent, info_hash, files in batch
+                        if files is None and (is_new or not self.check_torrent_in_client(torrent, info_hash))]
+            indexed = self.index_torrents([torrent for path, torrent, info_hash in to_index])
+            indexed_files = {}
+            for (path, torrent, info_hash), files in zip(to_index, indexed):
+                self.cache_index(info_hash, version, files)
+                indexed_files[path] = files
+            
+            for path, torrent, info_hash, files in batch:
+                yield self._handle_torrent(path, torrent, info_hash, indexed_files.get(path, files), dry_run, is_new)
+    
+    def _handle_torrentfiles_pool(self, paths, dry_run, is_new, jobs):
+        """
+        Handles torrentfiles indexed by a process pool, see handle_torrentfiles.
+        """
+        version = self.get_match_cache_version()
+        cached_info_hashes = set()
+        if self.match_cache is not None:
+            cached_info_hashes = self.match_cache.info_hashes(version)
+        
+        # the pool processes get the size filter with the database instead of each fetching it
+        self.db.fetch_size_filter()
+        
+        # the pool processes cannot open the database and piece hash cache while they are open for writing
+        self.db.close()
+        if self.piece_hash_cache is not None:
+            self.piece_hash_cache.close()
+        
+        new_hashes = []
+        try:
+            pool = multiprocessing.Pool(jobs, _init_index_worker, (self.db, self.get_index_settings(), self.torrents_seeded,
+                                                                   cached_info_hashes, is_new))
+            try:
+                for path, (torrent, info_hash, files, torrent_new_hashes) in zip(paths, pool.imap(_index_torrentfile, paths)):
+                    new_hashes.append(torrent_new_hashes)
+                    if info_hash in cached_info_hashes:
+                        files = self.get_cached_index(info_hash, version)
+                    else:
+                        self.cache_index(info_hash, version, files)
+                    yield self._handle_torrent(path, torrent, info_hash, files, dry_run, is_new)
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            self.db.open()
+            if self.piece_hash_cache is not None:
+                self.piece_hash_cache.open()
+                for torrent_new_hashes in new_hashes:
+                    for key, hashes in torrent_new_hashes.items():
+                        self.piece_hash_cache.set(key, hashes)
+    
+    def get_index_settings(self):
+        """
+        Returns the attributes used when indexing torrents, they are set on the AutoTorrent of each pool process.
+        """
+        return dict((name, getattr(self, name)) for name in self.index_settings)
+    
+    def get_match_cache_version(self):
+        """
+        Returns the version of the database the match cache is valid for.
+        """
+        if self.match_cache is None:
+            return None
+        
+        return '%s:%s:%s' % (self.db.get_database_id(), self.db.get_generation(), ','.join(self.db.get_scan_modes()))
+    
+    def get_cached_index(self, info_hash, version):
+        """
+        Returns the cached index result of a torrent, None if it is not cached.
+        """
+        if self.match_cache is None:
+            return None
+        
+        return self.match_cache.get(info_hash, version)
+    
+    def cache_index(self, info_hash, version, files):
+        """
+        Stores the index result of a torrent in the match cache.
+        """
+        if self.match_cache is None or files is None or isinstance(files, Exception):
+            return
+        
+        self.match_cache.set(info_hash, version, files)
+    
     def handle_torrentfile(self, path, dry_run=False, is_new=False):
         """
         Checks a torrentfile for files to seed, groups them by found / not found.
         The result will also include the total size of missing / not missing files.
         """
+        return next(self.handle_torrentfiles([path], dry_run, is_new))
+    
+    def _handle_torrent(self, path, torrent, info_hash, files, dry_run, is_new):
+        """
+        Handles an opened torrentfile, files is the index result if the torrent is already indexed.
+        """
         logger.info('Handling file %s' % path)
-
-        torrent = self.open_torrentfile(path)
-        found_size, missing_size, files = self.parse_torrent(torrent)
+        
+        if isinstance(files, Exception):
+            raise files
 
         if is_new:
+            found_size, missing_size, files = self.parse_torrent(torrent, files)
             if dry_run:
                 return "Dry run, added new torrent"
 
@@ -449,14 +995,14 @@ class AutoTorrent(object):
                 self.print_status(Status.FAILED_TO_ADD_TO_CLIENT, path, 'Failed to send new torrent to client')
                 return Status.FAILED_TO_ADD_TO_CLIENT
         else:
-            if self.check_torrent_in_client(torrent):
+            if self.check_torrent_in_client(torrent, info_hash):
                 self.print_status(Status.ALREADY_SEEDING, path, 'Already seeded')
                 if self.delete_torrents:
                     logger.info('Removing torrent %r' % path)
                     os.remove(path)
                 return Status.ALREADY_SEEDING
 
-            found_size, missing_size, files = self.parse_torrent(torrent)
+            found_size, missing_size, files = self.parse_torrent(torrent, files)
             missing_percent = (missing_size / (found_size + missing_size)) * 100
             found_percent = 100 - missing_percent
             would_not_add = missing_size and missing_percent > self.add_limit_percent or missing_size > self.add_limit_size
@@ -489,22 +1035,64 @@ class AutoTorrent(object):
                 logger.info('There are files found using hashing that needs rewriting.')
                 self.rewrite_hashed_files(destination_path, files['files'])
 
+            failed_files = []
+            if self.verify:
+                failed_files = self.verify_torrent(torrent, destination_path, files)
+                fast_resume = not failed_files
+                for failed_file in failed_files:
+                    logger.warning('File %r did not match the torrent' % failed_file)
+
             if self.delete_torrents:
                 logger.info('Removing torrent %r' % path)
                 os.remove(path)
 
             if self.client.add_torrent(torrent, destination_path, files['files'], fast_resume):
-                self.print_status(Status.OK, path, 'Torrent added successfully')
+                if failed_files:
+                    self.print_status(Status.OK, path, 'Torrent added, but pieces did not match in %s' % ', '.join(failed_files))
+                else:
+                    self.print_status(Status.OK, path, 'Torrent added successfully')
                 return Status.OK
             else:
                 self.print_status(Status.FAILED_TO_ADD_TO_CLIENT, path, 'Failed to send torrent to client')
                 return Status.FAILED_TO_ADD_TO_CLIENT
     
-    def check_torrent_in_client(self, torrent):
+    def verify_torrent(self, torrent, destination_path, files):
+        """
+        Checks every piece of the torrent against the files it is going to be seeded from.
+        Pieces of files that were not found are not checked.
+        
+        Returns a list of the files with pieces that did not match.
+        """
+        piece_size = torrent[b'info'][b'piece length']
+        paths = []
+        for f in files['files']:
+            if files['mode'] == 'exact':
+                file_path = f['actual_path']
+            elif f['completed'] or f.get('postprocessing'):
+                file_path = os.path.join(destination_path, *f['path'])
+            else:
+                file_path = None
+            paths.append((file_path, f['length']))
+        
+        logger.info('Verifying all pieces of the torrent')
+        status = verify_pieces(paths, piece_size, Pieces(torrent).pieces, self.verify_jobs)
+        
+        failed_files = []
+        offset = 0
+        for file_path, length in paths:
+            first_piece, last_piece = offset // piece_size, (offset + length - 1) // piece_size
+            if file_path is not None and length and False in status[first_piece:last_piece + 1]:
+                failed_files.append(file_path)
+            offset += length
+        
+        return failed_files
+    
+    def check_torrent_in_client(self, torrent, info_hash=None):
         """
-        Checks if a torrent is currently seeded
+        Checks if a torrent is currently seeded, info_hash can be passed if it is already known
         """
-        info_hash = self.get_info_hash(torrent)
+        if info_hash is None:
+            info_hash = self.get_info_hash(torrent)
         return info_hash in self.torrents_seeded
 
     def open_torrentfile(self, path):
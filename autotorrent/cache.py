@@ -0,0 +1,244 @@
+import hashlib
+import os
+import shelve
+import threading
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    Keeps the maxsize most recently used items, counting hits and misses.
+    """
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def __contains__(self, key):
+        return key in self.items
+    
+    def get(self, key, default=None):
+        """
+        Returns the item for key and marks it as recently used, default if it is not cached.
+        """
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        
+        self.items[key] = value
+        self.hits += 1
+        return value
+    
+    def set(self, key, value):
+        """
+        Caches an item, dropping the least recently used one if the cache is full.
+        """
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+    
+    def clear(self):
+        """
+        Drops all cached items, the counters are kept.
+        """
+        self.items.clear()
+
+class MatchCache(object):
+    """
+    Persistent cache of torrent index results.
+    
+    The results are only valid for the version they were made with, e.g. a database generation
+    and set of scan modes. Asking for another version than the cached one empties the cache.
+    """
+    VERSION_KEY = str('version')
+    
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.db = shelve.open(cache_file)
+        self.hits = 0
+        self.misses = 0
+    
+    def _check_version(self, version):
+        if self.db.get(self.VERSION_KEY) != version:
+            self.db.close()
+            self.db = shelve.open(self.cache_file, flag='n')
+            self.db[self.VERSION_KEY] = version
+    
+    def get(self, info_hash, version):
+        """
+        Returns the cached result for a torrent, None if it is not cached.
+        """
+        self._check_version(version)
+        result = self.db.get(str(info_hash))
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+    
+    def set(self, info_hash, version, result):
+        """
+        Caches the result for a torrent.
+        """
+        self._check_version(version)
+        self.db[str(info_hash)] = result
+    
+    def info_hashes(self, version):
+        """
+        Returns the info hashes of the cached torrents.
+        """
+        self._check_version(version)
+        return set(key for key in self.db.keys() if key != self.VERSION_KEY)
+    
+    def close(self):
+        self.db.close()
+
+class PieceHashCache(object):
+    """
+    Persistent cache of the hashes of pieces read from files on disk.
+    
+    The hashes of a file are kept by the offset they were read from and are only used for the
+    same path, inode, size, modification time and piece length. When more than max_hashes are cached,
+    the least recently used files are dropped until a tenth of max_hashes is free, so the files
+    are not sorted by usage on every set.
+    
+    The usage of the files is written to disk every sync_interval sets, files cached after
+    that, e.g. before a crash, are kept as the least recently used ones when the cache is opened again.
+    """
+    INDEX_KEY = str('index')
+    sync_interval = 100
+    
+    def __init__(self, cache_file, max_hashes=500000):
+        self.cache_file = cache_file
+        self.max_hashes = max_hashes
+        self.hits = 0
+        self.misses = 0
+        self.open()
+    
+    def open(self, read_only=False):
+        """
+        Opens the cache file, read_only allows other processes to read it at the same time.
+        Hashes set while read only are kept in new_hashes, see pop_new_hashes.
+        """
+        self.read_only = read_only
+        self.new_hashes = {}
+        self.lock = threading.Lock()
+        self.db = shelve.open(self.cache_file, flag='r' if read_only else 'c')
+        
+        self.index = self.db.get(self.INDEX_KEY, {}) # key -> [last used, number of hashes]
+        keys = set(key for key in self.db.keys() if key != self.INDEX_KEY)
+        for key in keys - set(self.index):
+            self.index[key] = [0, len(self.db[key])]
+        for key in set(self.index) - keys:
+            del self.index[key]
+        self.unsynced_sets = 0
+        
+        self.clock = max([last_used for last_used, _ in self.index.values()] or [0])
+        self.total_hashes = sum(count for _, count in self.index.values())
+    
+    def __getstate__(self):
+        """
+        Lets the cache be sent to another process, it must be opened there.
+        """
+        state = self.__dict__.copy()
+        state['db'] = state['lock'] = None
+        return state
+    
+    def __len__(self):
+        return self.total_hashes
+    
+    @staticmethod
+    def make_key(path, piece_size):
+        """
+        Creates the key of a file, it changes when the file is replaced or modified.
+        """
+        stat = os.stat(path)
+        key = '%r:%i:%i:%r:%i' % (path, stat.st_ino, stat.st_size, stat.st_mtime, piece_size)
+        return str(hashlib.sha256(key.encode('utf-8')).hexdigest())
+    
+    def _touch(self, key, count):
+        self.clock += 1
+        self.index[key] = [self.clock, count]
+    
+    def get(self, key):
+        """
+        Returns a dict of offset to hash of the cached hashes for a file.
+        """
+        with self.lock:
+            hashes = self.db.get(key)
+            if key in self.new_hashes:
+                hashes = dict(hashes or {})
+                hashes.update(self.new_hashes[key])
+            if hashes is None:
+                self.misses += 1
+                return {}
+            
+            self.hits += 1
+            self._touch(key, len(hashes))
+            return hashes
+    
+    def set(self, key, hashes):
+        """
+        Adds a dict of offset to hash to the cached hashes for a file.
+        """
+        with self.lock:
+            if self.read_only:
+                self.new_hashes.setdefault(key, {}).update(hashes)
+                return
+            
+            cached_hashes = self.db.get(key, {})
+            self.total_hashes -= len(cached_hashes)
+            cached_hashes.update(hashes)
+            self.db[key] = cached_hashes
+            self.total_hashes += len(cached_hashes)
+            self._touch(key, len(cached_hashes))
+            
+            if self.total_hashes > self.max_hashes:
+                self._evict()
+            
+            self.unsynced_sets += 1
+            if self.unsynced_sets >= self.sync_interval:
+                self._sync()
+    
+    def _evict(self):
+        max_hashes = self.max_hashes - self.max_hashes // 10
+        for key, (_, count) in sorted(self.index.items(), key=lambda x: x[1][0]):
+            if self.total_hashes <= max_hashes:
+                break
+            
+            del self.db[key]
+            del self.index[key]
+            self.total_hashes -= count
+    
+    def pop_new_hashes(self):
+        """
+        Returns and forgets the hashes set while the cache was read only, as a dict of key to hashes.
+        """
+        with self.lock:
+            new_hashes, self.new_hashes = self.new_hashes, {}
+            return new_hashes
+    
+    def sync(self):
+        """
+        Writes the cached hashes and their usage to disk.
+        """
+        with self.lock:
+            self._sync()
+    
+    def _sync(self):
+        self.db[self.INDEX_KEY] = self.index
+        self.db.sync()
+        self.unsynced_sets = 0
+    
+    def close(self):
+        if not self.read_only:
+            self.sync()
+        self.db.close()
@@ -30,6 +30,14 @@ class BaseClient(object):
         """
         raise NotImplemented
     
+    def get_files(self):
+        """
+        Returns the completed files of all torrents in the client.
+        
+        An iterable with a list of (path, size) for each torrent.
+        """
+        raise NotImplemented
+    
     def add_torrent(self, torrent, destination_path, files, fast_resume=True):
         """
         Adds a torrent to the torrent client.
@@ -113,6 +113,29 @@ class DelugeClient(BaseClient):
         result = self.rpcclient.call('core.get_torrents_status', {}, ['name'])
         return set(x.lower().decode('ascii') for x in result.keys())
 
+    def get_files(self):
+        """
+        Returns the completed files of all torrents.
+        """
+        logger.info('Getting the files of all torrents')
+        self._login()
+        result = self.rpcclient.call('core.get_torrents_status', {}, ['save_path', 'files', 'file_progress'])
+        
+        def decode(value):
+            if isinstance(value, bytes):
+                return value.decode('utf-8')
+            return value
+        
+        for status in result.values():
+            status = dict((decode(k), v) for k, v in status.items())
+            save_path = decode(status['save_path'])
+            torrent_files = []
+            for f, progress in zip(status['files'], status['file_progress']):
+                f = dict((decode(k), v) for k, v in f.items())
+                if progress >= 1.0:
+                    torrent_files.append((os.path.join(save_path, decode(f['path'])), f['size']))
+            yield torrent_files
+    
     def get_tname(self, thash):
         self._login()
         result = self.rpcclient.call('core.get_torrents_status', {}, ['name'])
@@ -8,7 +8,7 @@ import time
 import uuid
 
 from six.moves.urllib.parse import quote, urlsplit
-from six.moves.xmlrpc_client import ServerProxy
+from six.moves.xmlrpc_client import MultiCall, ServerProxy
 
 from ._base import BaseClient
 from ..bencode import bencode
@@ -115,6 +115,24 @@ class RTorrentClient(BaseClient):
         logger.info('Getting a list of torrent hashes')
         return set(x.lower() for x in self.proxy.download_list())
 
+    def get_files(self):
+        """
+        Returns the completed files of all torrents, fetched with
+        one d.multicall and one batch of f.multicall.
+        """
+        logger.info('Getting the files of all torrents')
+        torrents = self.proxy.d.multicall('main', 'd.get_hash=', 'd.get_directory=')
+        
+        multicall = MultiCall(self.proxy)
+        for infohash, directory in torrents:
+            multicall.f.multicall(infohash, '', 'f.get_path=', 'f.get_size_bytes=',
+                                  'f.get_completed_chunks=', 'f.get_size_chunks=')
+        
+        for (infohash, directory), files in zip(torrents, multicall()):
+            yield [(os.path.join(directory, path), size)
+                   for path, size, completed_chunks, size_chunks in files
+                   if completed_chunks == size_chunks]
+    
     def get_tname(self, thash):
         return self.proxy.d.get_name(thash)
 
@@ -92,6 +92,15 @@ class TestDelugeClient(TestCase):
                                                     1: 'tmp/tmp/file_b.txt',
                                                     2: 'tmp/tmp/file_c.txt'}})
     
+    def test_get_files(self):
+        self.client.rpcclient.torrents = {
+            b'a': {b'save_path': b'/data', b'file_progress': [1.0, 0.5],
+                   b'files': [{b'path': b'Some-Release/some-rls.rar', b'size': 10},
+                              {b'path': b'Some-Release/some-rls.r00', b'size': 10}]},
+        }
+        
+        self.assertEqual(list(self.client.get_files()), [[('/data/Some-Release/some-rls.rar', 10)]])
+    
     def test_auto_config_successful_config(self):
         os.environ['HOME'] = self._temp_path
         config_path = os.path.join(self._temp_path, '.config/deluge')
@@ -11,12 +11,24 @@ from ..rtorrent import RTorrentClient
 
 current_path = os.path.dirname(__file__)
 
+class MockDownloadProxy(object):
+    def __init__(self, proxy):
+        self.proxy = proxy
+    
+    def multicall(self, view, *commands):
+        return [[infohash, directory] for infohash, (directory, files) in sorted(self.proxy.files.items())]
+
 class MockXMLRPCProxy(object):
     def __init__(self):
         self.system = self
+        self.d = MockDownloadProxy(self)
         self.torrents = {}
+        self.files = {}
         self.allow_add = True
     
+    def multicall(self, calls):
+        return [[self.files[call['params'][0]][1]] for call in calls]
+    
     def listMethods(self):
         return ['view.list']
     
@@ -104,6 +116,17 @@ class TestRTorrentClient(TestCase):
         bitfield = resume_data[b'bitfield']
         self.assertEqual(bitfield, b'\x98') # bitfield: 10011 000
 
+    def test_get_files(self):
+        self.client.proxy.files = {
+            'A': ('/data/Some-Release', [['some-rls.rar', 10, 2, 2], ['some-rls.r00', 10, 1, 2]]),
+            'B': ('/data', [['single.mkv', 5, 1, 1]]),
+        }
+        
+        self.assertEqual(list(self.client.get_files()), [
+            [('/data/Some-Release/some-rls.rar', 10)],
+            [('/data/single.mkv', 5)],
+        ])
+    
     def test_auto_config_successful_config_port(self):
         os.environ['HOME'] = self._temp_path
         
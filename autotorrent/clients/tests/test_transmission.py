@@ -32,6 +32,13 @@ class TransmissionClient(RealTransmissionClient):
         elif method == 'torrent-rename-path':
             self._torrents[kwargs['ids'][0]].update(kwargs)
             return {}
+        elif method == 'torrent-get':
+            return {'torrents': [
+                {'downloadDir': '/data', 'files': [
+                    {'name': 'Some-Release/some-rls.rar', 'length': 10, 'bytesCompleted': 10},
+                    {'name': 'Some-Release/some-rls.r00', 'length': 10, 'bytesCompleted': 5},
+                ]},
+            ]}
         elif method == 'torrent-start':
             self._torrents[kwargs['ids'][0]]['paused'] = False
             return {}
@@ -70,6 +77,9 @@ class TestTransmissionClient(TestCase):
         self.assertTrue((2 in self.client._torrents))
         self.assertEqual(self.client._torrents[2]['paused'], False)
     
+    def test_get_files(self):
+        self.assertEqual(list(self.client.get_files()), [[('/data/Some-Release/some-rls.rar', 10)]])
+    
     def test_auto_config_successful_config(self):
         os.environ['HOME'] = self._temp_path
         config_path = os.path.join(self._temp_path, '.config/transmission-daemon')
@@ -117,6 +117,16 @@ class TransmissionClient(BaseClient):
         result = self.call('torrent-get', fields=['hashString'])
         return set(x['hashString'].lower() for x in result['torrents'])
     
+    def get_files(self):
+        """
+        Returns the completed files of all torrents.
+        """
+        logger.info('Getting the files of all torrents')
+        result = self.call('torrent-get', fields=['downloadDir', 'files'])
+        for torrent in result['torrents']:
+            yield [(os.path.join(torrent['downloadDir'], f['name']), f['length'])
+                   for f in torrent['files'] if f['bytesCompleted'] == f['length']]
+    
     def add_torrent(self, torrent, destination_path, files, fast_resume=True):
         """
         Add a new torrent to Transmission.
@@ -16,10 +16,13 @@ from six.moves import configparser, input
 
 from autotorrent.waitingfiles import WaitingFiles
 from autotorrent.at import AutoTorrent
+from autotorrent.cache import MatchCache, PieceHashCache
 from autotorrent.clients import TORRENT_CLIENTS
 from autotorrent.db import Database
+from autotorrent.dbserver import DatabaseServer, RemoteDatabase
 from autotorrent.humanize import humanize_bytes
 
+logger = logging.getLogger('autotorrent')
 
 class Color:
     BLACK = '\033[90m'
@@ -124,10 +127,18 @@ def commandline_handler():
 
     parser.add_argument("--create_config", dest="create_config_file", nargs='?', const='autotorrent.conf', default=None, help="Creates a new configuration file")
     parser.add_argument("-t", "--test_connection", action="store_true", dest="test_connection", default=False, help='Tests the connection to the torrent client')
-    parser.add_argument("--dry-run", nargs='?', const='txt', default=None, dest="dry_run", choices=['txt', 'json'], help="Don't do any actual adding, just scan for files needed for torrents.")
+    parser.add_argument("--dry-run", nargs='?', const='txt', default=None, dest="dry_run", choices=['txt', 'json', 'ndjson'], help="Don't do any actual adding, just scan for files needed for torrents. ndjson prints a line of json for each torrent as soon as it is scanned.")
     parser.add_argument("-r", "--rebuild", dest="rebuild", default=False, help='Rebuild the database', nargs='*')
+    parser.add_argument("--manifest", dest="manifest", default=None, nargs='+', help='Rebuild the database from file manifests instead of scanning the disks (used with -r)')
+    parser.add_argument("--from-client", action="store_true", dest="from_client", default=False, help='Rebuild the database from the files seeded by the torrent client instead of scanning the disks (used with -r)')
+    parser.add_argument("--export-db", dest="export_db", default=None, help='Export the database to a file that can be merged on another machine')
+    parser.add_argument("--merge-db", dest="merge_db", default=None, nargs='+', metavar='EXPORT[:LOCAL_PREFIX:MOUNT_PREFIX]',
+                        help='Replace the database with merged exports, optionally rewriting paths starting with LOCAL_PREFIX to MOUNT_PREFIX')
     parser.add_argument("-a", "--addfile", dest="addfile", default=False, help='Add a new torrent file to client', nargs='+')
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int, help='Number of processes used to index the torrents added with -a and to verify them')
+    parser.add_argument("--verify", action="store_true", dest="verify", default=False, help='Check every piece of the torrents before adding them, only verified torrents are added with fast resume')
     parser.add_argument("-d", "--delete_torrents", action="store_true", dest="delete_torrents", default=False, help='Delete torrents when they are added to the client')
+    parser.add_argument("--serve-db", action="store_true", dest="serve_db", default=False, help='Keep the database open and answer lookups on the db_socket configured')
     parser.add_argument("--verbose", help="increase output verbosity", action="store_true", dest="verbose")
     parser.add_argument("-o", "--loopmode", dest="loopmode", default=False, help='Enable loop mode (scan directory '
                                                                                  'for torrents every few seconds)', nargs='?')
@@ -229,10 +240,38 @@ def commandline_handler():
     hash_size_mode = 'hash_size' in scan_mode
     hash_slow_mode = 'hash_slow' in scan_mode
     
-    db = Database(config.get('general', 'db'), disks,
-                  config.get('general', 'ignore_files').split(','),
-                  normal_mode, unsplitable_mode, exact_mode,
-                  hash_name_mode, hash_size_mode, hash_slow_mode)
+    db_socket = None
+    if config.has_option('general', 'db_socket'):
+        db_socket = os.path.abspath(config.get('general', 'db_socket'))
+    
+    if args.serve_db and not db_socket:
+        parser.error('db_socket must be configured to serve the database')
+    
+    if db_socket and not args.serve_db and RemoteDatabase.is_alive(db_socket):
+        if isinstance(args.rebuild, list) or args.merge_db or args.export_db or args.loopmode is not False:
+            parser.error('The database cannot be rebuilt, merged or exported while the database server is running, stop it first')
+        
+        logger.info('Using database server at %r' % db_socket)
+        db = RemoteDatabase(db_socket, disks,
+                            config.get('general', 'ignore_files').split(','),
+                            normal_mode, unsplitable_mode, exact_mode,
+                            hash_name_mode, hash_size_mode, hash_slow_mode)
+    else:
+        db = Database(config.get('general', 'db'), disks,
+                      config.get('general', 'ignore_files').split(','),
+                      normal_mode, unsplitable_mode, exact_mode,
+                      hash_name_mode, hash_size_mode, hash_slow_mode)
+    
+    if args.serve_db:
+        server = DatabaseServer(db, db_socket)
+        print('Serving database on %s (press ctrl-c to exit)' % db_socket)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        quit()
     
     client_option = 'client'
     if args.client != 'default':
@@ -252,6 +291,16 @@ def commandline_handler():
     client_options.pop('client')
     client = TORRENT_CLIENTS[client_name](**client_options)
     
+    match_cache = None
+    if config.has_option('general', 'match_cache'):
+        match_cache = MatchCache(config.get('general', 'match_cache'))
+    
+    piece_hash_cache = None
+    if config.has_option('general', 'piece_hash_cache'):
+        piece_hash_cache = PieceHashCache(config.get('general', 'piece_hash_cache'))
+        if config.has_option('general', 'piece_hash_cache_size'):
+            piece_hash_cache.max_hashes = config.getint('general', 'piece_hash_cache_size')
+    
     at = AutoTorrent(
         db,
         client,
@@ -260,8 +309,27 @@ def commandline_handler():
         config.getfloat('general', 'add_limit_percent'),
         args.delete_torrents,
         (config.get('general', 'link_type') if config.has_option('general', 'link_type') else 'soft'),
+        match_cache,
+        args.verify,
+        args.jobs,
+        piece_hash_cache,
     )
     
+    if config.has_option('general', 'hash_check_workers'):
+        at.hash_check_workers = config.getint('general', 'hash_check_workers')
+    
+    if config.has_option('general', 'hash_check_device_workers'):
+        at.hash_check_device_workers = config.getint('general', 'hash_check_device_workers')
+    
+    if config.has_option('general', 'link_workers'):
+        at.link_workers = config.getint('general', 'link_workers')
+    
+    if config.has_option('general', 'link_folders'):
+        at.link_folders = config.getboolean('general', 'link_folders')
+    
+    if config.has_option('general', 'sparse_padding'):
+        at.sparse_padding = config.getboolean('general', 'sparse_padding')
+    
     if args.test_connection:
         proxy_test_result = client.test_connection()
         if proxy_test_result:
@@ -269,7 +337,26 @@ def commandline_handler():
             print('  result: %s' % proxy_test_result)
     
     if isinstance(args.rebuild, list):
-        if args.rebuild:
+        if args.from_client:
+            if args.rebuild:
+                print('Adding new folders to database from torrent client')
+                db.rebuild_from_client(client, args.rebuild)
+                print('Added to database')
+            else:
+                print('Rebuilding database from torrent client')
+                db.rebuild_from_client(client)
+                print('Database rebuilt')
+        elif args.manifest:
+            manifest_files = [os.path.join(current_path, m) for m in args.manifest]
+            if args.rebuild:
+                print('Adding new folders to database from manifests')
+                db.rebuild_from_manifest(manifest_files, args.rebuild)
+                print('Added to database')
+            else:
+                print('Rebuilding database from manifests')
+                db.rebuild_from_manifest(manifest_files)
+                print('Database rebuilt')
+        elif args.rebuild:
             print('Adding new folders to database')
             db.rebuild(args.rebuild)
             print('Added to database')
@@ -278,8 +365,25 @@ def commandline_handler():
             db.rebuild()
             print('Database rebuilt')
 
+    if args.merge_db:
+        exports = []
+        for merge_db in args.merge_db:
+            path_rewrite = None
+            if merge_db.count(':') >= 2:
+                merge_db, local_prefix, mount_prefix = merge_db.rsplit(':', 2)
+                path_rewrite = (local_prefix, mount_prefix)
+            exports.append((os.path.join(current_path, merge_db), path_rewrite))
+        
+        print('Merging %i exports into database' % len(exports))
+        db.merge_exports(exports)
+        print('Database merged')
+    
+    if args.export_db:
+        db.export(os.path.join(current_path, args.export_db))
+        print('Database exported to %s' % args.export_db)
+    
     if args.addfile:
-        addtfile(at, current_path, args.addfile, args.dry_run)
+        addtfile(at, current_path, args.addfile, args.dry_run, False, args.jobs)
 
     if args.loopmode:
         wf = WaitingFiles()
@@ -405,36 +509,47 @@ def commandline_handler():
 
     print('Goodbye!')
 
-def addtfile(at, current_path, afiles, adry_run, is_new):
+def addtfile(at, current_path, afiles, adry_run, is_new, jobs=1):
     dry_run = bool(adry_run)
     dry_run_data = []
     if not dry_run:
         at.populate_torrents_seeded()
 
-    for torrent in afiles:
-        result = at.handle_torrentfile(os.path.join(current_path, torrent), dry_run, is_new)
+    paths = [os.path.join(current_path, torrent) for torrent in afiles]
+    for torrent, result in zip(afiles, at.handle_torrentfiles(paths, dry_run, is_new, jobs)):
         if dry_run:
-            dry_run_data.append({
+            torrent_data = {
                 'torrent': torrent,
                 'found_bytes': result[0],
                 'missing_bytes': result[1],
                 'would_add': not result[2],
                 'local_files': result[3],
-            })
-
-    if dry_run:
-        if dry_run == 'json':
-            print(json.dumps(dry_run_data))
-        elif dry_run == 'txt':
-            for torrent in dry_run_data:
-                print('Torrent: %s' % torrent['torrent'])
-                print(' Found data: %s - Missing data: %s - Would add: %s' % (humanize_bytes(torrent['found_bytes']),
-                                                                              humanize_bytes(torrent['missing_bytes']),
-                                                                              torrent['would_add'] and 'Yes' or 'No'))
-                print(' Local files used:')
-                for f in torrent['local_files']:
-                    print('  %s' % f)
-                print('')
+            }
+            if adry_run == 'ndjson':
+                sys.stdout.write(json.dumps(torrent_data) + '\n')
+                sys.stdout.flush()
+            else:
+                dry_run_data.append(torrent_data)
+
+    logger.debug('Lookup cache had %i hits and %i misses' % (at.db.lookup_cache.hits, at.db.lookup_cache.misses))
+    if at.match_cache is not None:
+        logger.debug('Match cache had %i hits and %i misses' % (at.match_cache.hits, at.match_cache.misses))
+    if at.piece_hash_cache is not None:
+        at.piece_hash_cache.sync()
+        logger.debug('Piece hash cache had %i hits and %i misses' % (at.piece_hash_cache.hits, at.piece_hash_cache.misses))
+
+    if adry_run == 'json':
+        print(json.dumps(dry_run_data))
+    elif adry_run == 'txt':
+        for torrent in dry_run_data:
+            print('Torrent: %s' % torrent['torrent'])
+            print(' Found data: %s - Missing data: %s - Would add: %s' % (humanize_bytes(torrent['found_bytes']),
+                                                                          humanize_bytes(torrent['missing_bytes']),
+                                                                          torrent['would_add'] and 'Yes' or 'No'))
+            print(' Local files used:')
+            for f in torrent['local_files']:
+                print('  %s' % f)
+            print('')
 
 
 def print_status(status, info, message, current_path):
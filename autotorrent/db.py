@@ -1,27 +1,114 @@
 from __future__ import division, unicode_literals
 
+import base64
 import hashlib
+import json
 import logging
 import os
 import shelve
+import uuid
 
+from collections import namedtuple
 from fnmatch import fnmatch
+from functools import wraps
 
-from .utils import is_unsplitable, get_root_of_unsplitable
+import six
+
+from .cache import LRUCache
+from .utils import is_unsplitable, is_scene_folder, get_root_of_unsplitable, threaded_iterator, BloomFilter
 
 logger = logging.getLogger(__name__)
 
+MANIFEST_READ_SIZE = 65536
+
+EXPORT_VERSION = 1
+SIZE_FILTER_KEY = str('size_filter')
+GENERATION_KEY = str('generation')
+DATABASE_ID_KEY = str('database_id')
+
+FileStat = namedtuple('FileStat', ['st_size', 'st_mtime', 'st_ino']) # mtime and inode are None when unknown
+
+def read_manifest(manifest_file):
+    """
+    Reads a manifest and yields (path, FileStat) for every file in it.
+    
+    Each record is "size mtime inode path", e.g. as created by
+    find /mnt/disk -type f -printf '%s %T@ %i %p\\0'
+    The records are separated by NUL, or by newline if there are no NUL in the file.
+    """
+    with open(manifest_file, 'rb') as f:
+        data = f.read(MANIFEST_READ_SIZE)
+        delimiter = b'\x00' if b'\x00' in data else b'\n'
+        
+        while data:
+            records = data.split(delimiter)
+            data = records.pop()
+            chunk = f.read(MANIFEST_READ_SIZE)
+            if not chunk:
+                records.append(data)
+                data = b''
+            else:
+                data += chunk
+            
+            for record in records:
+                if not record.strip():
+                    continue
+                
+                try:
+                    size, mtime, inode, path = record.split(None, 3)
+                    path = path.rstrip(b'\r\n')
+                    if not six.PY2: # undecodable bytes are kept as surrogates, like os.walk does
+                        path = os.fsdecode(path)
+                    yield path, FileStat(int(size), float(mtime), int(inode))
+                except ValueError:
+                    logger.error('Failed to parse manifest record %r' % record)
+
+class DatabaseExportException(Exception):
+    pass
+
+_missing = object()
+
+def cached_lookup(func):
+    """
+    Caches the results of a database lookup method in the lookup cache of the database.
+    """
+    @wraps(func)
+    def wrapper(self, *args):
+        key = (func.__name__, ) + tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+        value = self.lookup_cache.get(key, _missing)
+        if value is _missing:
+            value = func(self, *args)
+            self.lookup_cache.set(key, value)
+        
+        if isinstance(value, list): # do not let the caller change the cached value
+            value = list(value)
+        return value
+    return wrapper
+
 class Database(object):
     hash_mode_size_varying = 10.0 # 10% size variation from size on disk for the two scan modes
                                   # that allows size to vary
+    rebuild_queue_size = 1000 # max number of items waiting between two stages of a rebuild
+    rebuild_batch_size = 500 # number of inserts written to the database at a time
+    lookup_cache_size = 10000 # number of lookup results kept in memory
     
     def __init__(self, db_file, paths, ignore_files, normal_mode, unsplitable_mode, exact_mode,
                  hash_name_mode, hash_size_mode, hash_slow_mode):
         """
         Database used to match files and torrents.
         """
-        self.db = shelve.open(db_file)
         self.db_file = db_file
+        self.open()
+        self._set_scan_settings(paths, ignore_files, normal_mode, unsplitable_mode, exact_mode,
+                                hash_name_mode, hash_size_mode, hash_slow_mode)
+        self.size_filter = self.load_size_filter()
+        self.lookup_cache = LRUCache(self.lookup_cache_size)
+    
+    def _set_scan_settings(self, paths, ignore_files, normal_mode, unsplitable_mode, exact_mode,
+                           hash_name_mode, hash_size_mode, hash_slow_mode):
+        """
+        Sets the paths and scan modes the database is built and searched with.
+        """
         self.paths = paths
         self.ignore_files = [self.normalize_filename(x) for x in ignore_files]
         self.normal_mode = normal_mode
@@ -33,69 +120,124 @@ class Database(object):
         self.hash_mode = hash_name_mode or hash_size_mode or hash_slow_mode
         self.hash_size_table = None
     
+    def open(self, read_only=False):
+        """
+        Opens the database file, read_only allows other processes to read it at the same time.
+        """
+        self.db = shelve.open(self.db_file, flag='r' if read_only else 'c')
+        if not read_only and DATABASE_ID_KEY not in self.db:
+            self.db[DATABASE_ID_KEY] = uuid.uuid4().hex
+    
+    def close(self):
+        """
+        Closes the database file.
+        """
+        self.db.close()
+    
+    def __getstate__(self):
+        """
+        Lets the database be sent to another process, it must be opened there.
+        """
+        state = self.__dict__.copy()
+        state['db'] = None
+        return state
+    
     def truncate(self):
         """
         Truncates the database
         """
         logger.info('Truncated the database')
+        generation = self.get_generation()
         self.db.close()
         self.db = shelve.open(self.db_file, flag='n')
+        self.db[GENERATION_KEY] = generation + 1
+        self.db[DATABASE_ID_KEY] = uuid.uuid4().hex
+        self.size_filter = set() # the distinct sizes are collected until the filter can be sized for them
+        self.lookup_cache.clear()
     
-    def insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None):
+    def get_generation(self):
         """
-        Wraps the database insert to catch exceptions
+        Returns the generation of the database, it changes every time the database is changed.
         """
-        try:
-            self._insert_into_database(root, f, mode, prefix, unsplitable_name)
-        except UnicodeDecodeError:
-            logger.error('Failed to insert %r / %r / %r' % (root, f, mode))
-
-    def _insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None):
+        return self.db.get(GENERATION_KEY, 0)
+    
+    def get_database_id(self):
         """
-        Does the actual insertion into the database.
+        Returns the random id given to the database file when it was created,
+        a database file replaced by another one has a different id even if the generation is the same.
         """
-        path = os.path.abspath(os.path.join(root, f))
-        if not os.path.exists(path):
-            return
-
-        if not os.access(path, os.R_OK):
-            logger.warning('Path %r is not accessible, skipping' % path)
-            return
+        return self.db.get(DATABASE_ID_KEY)
+    
+    def bump_generation(self):
+        """
+        Marks the database as changed.
+        """
+        self.db[GENERATION_KEY] = self.get_generation() + 1
+    
+    def load_size_filter(self):
+        """
+        Loads the filter of file sizes found on disk from the database.
         
-        if mode == 'exact':
-            key = self.keyify(prefix, f)
-            if key in self.db:
-                self.db[key] = self.db[key] + [path]
-            else:
-                self.db[key] = [path]
+        Returns None if the database has no filter or it does not cover all files,
+        e.g. when built by an older version.
+        """
+        data = self.db.get(SIZE_FILTER_KEY)
+        if data is None:
+            return None
+        
+        return BloomFilter(data=data)
+    
+    def build_size_filter(self):
+        """
+        Turns the sizes collected since the database was truncated into a filter sized for them.
+        Files added later without truncating are added to the filter as it is.
+        """
+        if isinstance(self.size_filter, set):
+            logger.debug('Building size filter for %i sizes' % len(self.size_filter))
+            self.size_filter = BloomFilter.from_values(self.size_filter)
+    
+    def fetch_size_filter(self):
+        """
+        Makes sure the filter of file sizes is in memory, e.g. before the database is sent to other processes.
+        """
+        pass # loaded when the database is created
+    
+    def save_size_filter(self):
+        """
+        Writes the filter of file sizes to the database.
+        """
+        self.build_size_filter()
+        if self.size_filter is None:
+            if SIZE_FILTER_KEY in self.db:
+                del self.db[SIZE_FILTER_KEY]
         else:
-            normalized_filename = self.normalize_filename(f)
-            size = os.path.getsize(path)
-            
-            if mode.startswith('hash_'):
-                if mode == 'hash_store_name': # the size can vary, name is exact. I.e. filename to path mapping
-                    key = self.keyify(normalized_filename)
-                elif mode == 'hash_store_size': # the name can vary, size is exact (same db can be used for slow-mo). I.e. size to path mapping
-                    key = str('s:%i' % size)
-                self.db[key] = self.db.get(key, []) + [path]
-            else:
-                if mode == 'unsplitable':
-                    split_root = root.split(os.sep)
-                    p_index = len(split_root) - split_root[::-1].index(unsplitable_name) - 1
-                    p = [self.normalize_filename(x) for x in split_root[p_index:]] + [normalized_filename]
-                    
-                    key = self.keyify(size, *p)
-                elif mode == 'normal':
-                    key = self.keyify(size, normalized_filename)
-                
-                if key in self.db: # check if same file
-                    if os.path.exists(self.db[key]):
-                        old_inode = os.stat(self.db[key]).st_ino
-                        new_inode = os.stat(path).st_ino
-                        if old_inode != new_inode:
-                            logger.warning('Duplicate key %s and %s' % (path, self.db[key]))
+            self.db[SIZE_FILTER_KEY] = self.size_filter.to_bytes()
     
-                self.db[key] = path
+    def dump_size_filter(self):
+        """
+        Returns the filter of file sizes as a base64 string, None if there is no filter.
+        """
+        if self.size_filter is None:
+            return None
+        
+        return base64.b64encode(self.size_filter.to_bytes()).decode('ascii')
+    
+    def has_size(self, size):
+        """
+        Checks if a file with size might be in the database.
+        A file with a size that is not found cannot be matched by name and size.
+        """
+        return self.size_filter is None or size in self.size_filter
+    
+    def insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None):
+        """
+        Inserts a single file into the database.
+        
+        The keys are written directly. Unlike a rebuild, the size filter is not saved and the
+        generation is not bumped, so cached matches stay valid.
+        """
+        job = (mode, root, f, prefix if mode == 'exact' else unsplitable_name, None)
+        self._write_batch(list(self._key_stage(self._stat_stage([job]))))
     
     def skip_file(self, f):
         """
@@ -107,9 +249,365 @@ class Database(object):
                 return True
         return False
     
+    def _is_unsplitable_root(self, path, files, dirs):
+        """
+        Checks if path is the head folder of an unsplitable release, i.e. if the folder
+        itself or a chain of scene folders (cd1, sample, bdmv etc.) below it contains
+        unsplitable files.
+        """
+        name = os.path.basename(path.rstrip(os.sep))
+        if not name or is_scene_folder(name):
+            return False
+        
+        return self._has_unsplitable_files(path, files, dirs)
+    
+    def _has_unsplitable_files(self, path, files, dirs):
+        """
+        Looks for unsplitable files in path and the scene folders below it.
+        """
+        if is_unsplitable(files):
+            return True
+        
+        for d in dirs:
+            if not is_scene_folder(d):
+                continue
+            
+            sub_path = os.path.join(path, d)
+            if os.path.islink(sub_path): # not followed when walking either
+                continue
+            
+            for _, sub_dirs, sub_files in os.walk(sub_path):
+                if self._has_unsplitable_files(sub_path, sub_files, sub_dirs):
+                    return True
+                break
+        
+        return False
+    
+    def _walk_stage(self, paths):
+        """
+        Walks the paths and yields (root, dirs, files, unsplitable_path, stats) for every folder
+        found. unsplitable_path is the head folder of the unsplitable release the folder is
+        part of, if any. stats is None as the files are stat'ed later.
+        
+        Memory use grows with the depth of the tree and the size of the folders, not with the
+        number of files in it. os.walk keeps the subfolder names of every folder above the current one,
+        and only the unsplitable releases above the current folder are remembered.
+        """
+        special_mode = self.unsplitable_mode or self.exact_mode
+        for root_path in paths:
+            logger.info('Scanning %s' % root_path)
+            release_roots = []
+            for root, dirs, files in os.walk(root_path):
+                unsplitable_path = None
+                if special_mode:
+                    while release_roots and not (root + os.sep).startswith(release_roots[-1].rstrip(os.sep) + os.sep):
+                        release_roots.pop()
+                    
+                    if self._is_unsplitable_root(root, files, dirs):
+                        logger.debug('Found unsplitable path %r' % root)
+                        release_roots.append(root)
+                    
+                    if release_roots:
+                        unsplitable_path = release_roots[-1]
+                
+                yield root, dirs, files, unsplitable_path, None
+            logger.info('Done scanning %s' % root_path)
+    
+    def _listing_walk_stage(self, listing, paths):
+        """
+        Yields the files from a listing the same way as _walk_stage, with known stats.
+        Only files inside the paths are used and a file listed more than once is used once.
+        
+        listing is an iterable of (path, FileStat) in any order. The files are grouped by folder
+        and the folders are yielded depth first, the way a walk finds them, so the whole
+        listing inside the paths is kept in memory.
+        """
+        paths = [p.rstrip(os.sep) + os.sep for p in paths]
+        def find_root_path(path):
+            for root_path in paths:
+                if path.startswith(root_path):
+                    return root_path
+        
+        folders = {}
+        file_count = 0
+        for path, stat in listing:
+            if not find_root_path(path):
+                continue
+            
+            root, f = os.path.split(path)
+            folder = folders.setdefault(root, {})
+            if f not in folder:
+                file_count += 1
+            folder[f] = stat
+        logger.info('Found %i files in %i folders inside the paths' % (file_count, len(folders)))
+        
+        unsplitable_paths = set()
+        if self.unsplitable_mode or self.exact_mode:
+            for root, stats in folders.items():
+                if not is_unsplitable(stats):
+                    continue
+                
+                sep_root = root.split(os.sep)
+                name = get_root_of_unsplitable(sep_root)
+                if not name:
+                    continue
+                
+                while sep_root[-1] != name:
+                    sep_root.pop()
+                path = os.sep.join(sep_root)
+                logger.debug('Found unsplitable path %r' % path)
+                unsplitable_paths.add(path)
+        
+        def find_unsplitable_path(root):
+            sep_root = root.split(os.sep)
+            while sep_root:
+                path = os.sep.join(sep_root)
+                if path in unsplitable_paths:
+                    return path
+                sep_root.pop()
+        
+        seen_folders = set()
+        for root in sorted(folders, key=lambda root: root.split(os.sep)): # a folder is followed by everything below it
+            stats = folders.pop(root)
+            if self.exact_mode: # the folders are not listed, so they are found from the files
+                root_path = find_root_path(root + os.sep)
+                folder = root
+                while len(folder) >= len(root_path) and folder not in seen_folders:
+                    seen_folders.add(folder)
+                    parent, d = os.path.split(folder)
+                    yield parent, [d], [], find_unsplitable_path(parent), {d: FileStat(0, None, None)}
+                    folder = parent
+            
+            yield root, [], sorted(stats), find_unsplitable_path(root), stats
+    
+    def _manifest_listing(self, manifest_files):
+        """
+        Lists the files in the manifests.
+        """
+        for manifest_file in manifest_files:
+            logger.info('Scanning manifest %s' % manifest_file)
+            for path, stat in read_manifest(manifest_file):
+                yield path, stat
+            logger.info('Done scanning manifest %s' % manifest_file)
+    
+    def _filter_stage(self, walked):
+        """
+        Turns walked folders into insert jobs, (mode, root, name, extra, stat), depending on the enabled scan modes.
+        extra is the prefix for exact mode and the release name for unsplitable mode.
+        stat is the known stat of the file, if any.
+        
+        All the jobs for a file are yielded after each other.
+        """
+        signature_mode = self.normal_mode or self.unsplitable_mode
+        for root, dirs, files, unsplitable_path, stats in walked:
+            stats = stats or {}
+            unsplitable_name = None
+            if unsplitable_path is not None and self.unsplitable_mode:
+                unsplitable_name = os.path.basename(unsplitable_path.rstrip(os.sep))
+                logger.debug('Looks like we found a unsplitable release in %r' % unsplitable_path)
+            
+            for f in files:
+                stat = stats.get(f)
+                if signature_mode:
+                    yield 'signature', root, f, None, stat
+                
+                if unsplitable_name is not None:
+                    yield 'unsplitable', root, f, unsplitable_name, stat
+                    continue
+                
+                if unsplitable_path is None:
+                    if self.normal_mode and not self.skip_file(f):
+                        yield 'normal', root, f, None, stat
+                    
+                    if self.exact_mode:
+                        yield 'exact', root, f, 'f', stat
+                
+                if self.hash_size_mode or self.hash_slow_mode:
+                    yield 'hash_store_size', root, f, None, stat
+                
+                if self.hash_name_mode:
+                    yield 'hash_store_name', root, f, None, stat
+            
+            if unsplitable_path is None and self.exact_mode:
+                for d in dirs:
+                    yield 'exact', root, d, 'd', stats.get(d)
+    
+    def _stat_file(self, path):
+        """
+        Stats a file, returns None if it is gone or inaccessible.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        
+        if not os.access(path, os.R_OK):
+            logger.warning('Path %r is not accessible, skipping' % path)
+            return None
+        
+        return stat
+    
+    def _stat_stage(self, jobs):
+        """
+        Stats the files from the insert jobs, skipping the ones that are gone or inaccessible.
+        Yields the jobs together with the absolute path and the stat result.
+        
+        Jobs with a known stat are not checked on disk and a file with several jobs is only stat'ed once.
+        """
+        last_path, last_stat = None, None
+        for mode, root, f, extra, stat in jobs:
+            try:
+                path = os.path.abspath(os.path.join(root, f))
+            except UnicodeDecodeError:
+                logger.error('Failed to insert %r / %r / %r' % (root, f, mode))
+                continue
+            
+            if stat is None:
+                if path != last_path:
+                    last_path, last_stat = path, self._stat_file(path)
+                stat = last_stat
+            
+            if stat is None:
+                continue
+            
+            yield mode, root, f, extra, path, stat
+    
+    def _signature_stage(self, stated, paths):
+        """
+        Computes the signature of the folders below paths from the signature jobs,
+        see folder_signature. Other jobs are passed on untouched.
+        
+        The files must be grouped by folder the way a walk finds them. A folder is done
+        when the files leave it. Until then, it and every folder above it keep an entry for each
+        file and subfolder found in them so far. Memory therefore grows with the size of the
+        folders on the current path, not with the size of the tree.
+        Done folders are yielded as ('folder_signature', folder, None, signature, folder, None).
+        """
+        paths = set(os.path.abspath(p) for p in paths)
+        path_prefixes = tuple(p.rstrip(os.sep) + os.sep for p in paths)
+        stack = [] # (folder, entries) for the folder of the last file and the folders above it
+        
+        def done():
+            folder, entries = stack.pop()
+            signature = self._signature(entries)
+            if stack:
+                stack[-1][1].append('%s|d:%s' % (os.path.basename(folder), signature))
+            
+            if folder.startswith(path_prefixes):
+                return 'folder_signature', folder, None, signature, folder, None
+        
+        for item in stated:
+            mode, root, f, extra, path, stat = item
+            if mode != 'signature':
+                yield item
+                continue
+            
+            folder = os.path.dirname(path)
+            while stack and not (folder + os.sep).startswith(stack[-1][0].rstrip(os.sep) + os.sep):
+                result = done()
+                if result:
+                    yield result
+            
+            folders = []
+            while not stack or folder != stack[-1][0]:
+                folders.append(folder)
+                parent = os.path.dirname(folder)
+                if (not stack and folder in paths) or parent == folder:
+                    break
+                folder = parent
+            
+            for folder in reversed(folders):
+                stack.append((folder, []))
+            
+            stack[-1][1].append('%s|f:%i' % (f, stat.st_size))
+        
+        while stack:
+            result = done()
+            if result:
+                yield result
+    
+    def _key_stage(self, stated):
+        """
+        Creates the database key for stated insert jobs and yields (mode, key, path, inode).
+        """
+        for mode, root, f, extra, path, stat in stated:
+            try:
+                if mode == 'exact':
+                    key = self.keyify(extra, f)
+                elif mode == 'hash_store_name': # the size can vary, name is exact. I.e. filename to path mapping
+                    key = self.keyify(self.normalize_filename(f))
+                elif mode == 'hash_store_size': # the name can vary, size is exact (same db can be used for slow-mo). I.e. size to path mapping
+                    key = str('s:%i' % stat.st_size)
+                elif mode == 'unsplitable':
+                    split_root = root.split(os.sep)
+                    p_index = len(split_root) - split_root[::-1].index(extra) - 1
+                    p = [self.normalize_filename(x) for x in split_root[p_index:] if x] + [self.normalize_filename(f)]
+                    key = self.keyify(stat.st_size, *p)
+                elif mode == 'normal':
+                    key = self.keyify(stat.st_size, self.normalize_filename(f))
+                elif mode == 'folder_signature':
+                    yield mode, str('g:%s' % extra), path, None
+                    continue
+            except UnicodeDecodeError:
+                logger.error('Failed to insert %r / %r / %r' % (root, f, mode))
+                continue
+            
+            if self.size_filter is not None and mode != 'exact':
+                self.size_filter.add(stat.st_size)
+            
+            yield mode, key, path, stat.st_ino
+    
+    def _write_stage(self, keyed):
+        """
+        Writes keyed insert jobs into the database in batches.
+        """
+        batch = []
+        for item in keyed:
+            batch.append(item)
+            if len(batch) >= self.rebuild_batch_size:
+                self._write_batch(batch)
+                batch = []
+        
+        if batch:
+            self._write_batch(batch)
+        
+        self.save_size_filter()
+        self.bump_generation()
+    
+    def _write_batch(self, batch):
+        """
+        Writes a batch of keyed insert jobs. Keys storing a list of paths are only read and
+        written once per batch.
+        """
+        self.lookup_cache.clear()
+        appended = {}
+        appended_keys = []
+        for mode, key, path, inode in batch:
+            if mode in ('exact', 'folder_signature') or mode.startswith('hash_'):
+                if key not in appended:
+                    appended[key] = []
+                    appended_keys.append(key)
+                appended[key].append(path)
+            else:
+                old_path = self.db.get(key)
+                if inode is not None and old_path and os.path.exists(old_path): # check if same file
+                    if os.stat(old_path).st_ino != inode:
+                        logger.warning('Duplicate key %s and %s' % (path, old_path))
+                
+                self.db[key] = path
+        
+        for key in appended_keys:
+            old_paths = self.db.get(key, [])
+            self.db[key] = old_paths + [path for path in appended[key] if path not in old_paths]
+    
     def rebuild(self, paths=None):
         """
         Scans the paths for files and rebuilds the database.
+        
+        The scan is done as a pipeline of walk, filter, stat, key and write stages.
+        Walking and stat'ing run in their own threads with bounded queues between the stages,
+        so the disk I/O overlaps. Besides the queues, memory use grows with the depth of the tree
+        and the size of the folders being walked, see _walk_stage and _signature_stage.
         """
         if paths:
             logger.info('Just adding new paths')
@@ -118,74 +616,149 @@ class Database(object):
             self.truncate()
             paths = self.paths
         
-        unsplitable_paths = set()
-        if self.unsplitable_mode or self.exact_mode:
-            logger.info('Special modes enabled, doing a preliminary scan')
-            for root_path in paths:
-                logger.info('Preliminary scanning %s' % root_path)
-                for root, dirs, files in os.walk(root_path):
-                    if is_unsplitable(files):
-                        sep_root = root.split(os.sep)
-                        name = get_root_of_unsplitable(root.split(os.sep))
-                        while sep_root[-1] != name:
-                            sep_root.pop()
-                        path = os.path.join(*sep_root)
-                        logger.debug('Found unsplitable path %r' % path)
-                        unsplitable_paths.add(path)
-                logger.info('Done preliminary scanning %s' % root_path)
+        self._rebuild(self._walk_stage(paths), paths)
+    
+    def rebuild_from_manifest(self, manifest_files, paths=None):
+        """
+        Rebuilds the database from manifests listing the files instead of scanning the disks,
+        see read_manifest for the format.
         
-        for root_path in paths:
-            logger.info('Scanning %s' % root_path)
-            for root, dirs, files in os.walk(root_path):
-                unsplitable = False
-                if self.unsplitable_mode or self.exact_mode:
-                    sep_root = root.split(os.sep)
-                    while sep_root:
-                        if os.path.join(*sep_root) in unsplitable_paths:
-                            break
-                        sep_root.pop()
-                    
-                    if sep_root:
-                        unsplitable = True
-                        if self.unsplitable_mode:
-                            unsplitable_name = sep_root[-1]
-                            logger.info('Looks like we found a unsplitable release in %r' % (os.sep.join(sep_root)))
-                            for f in files:
-                                self.insert_into_database(root, f, 'unsplitable', unsplitable_name=unsplitable_name)
-                            continue
-                
-                if not unsplitable:
-                    if self.normal_mode:
-                        for f in files:
-                            if self.skip_file(f):
-                                continue
-                            
-                            self.insert_into_database(root, f, 'normal')
-                        
-                    if self.exact_mode:
-                        for f in files:
-                            self.insert_into_database(root, f, 'exact', 'f')
-                        
-                        for d in dirs:
-                            self.insert_into_database(root, d, 'exact', 'd')
-                
-                if self.hash_name_mode or self.hash_size_mode or self.hash_slow_mode:
-                    for f in files:
-                        if self.hash_size_mode or self.hash_slow_mode:
-                            self.insert_into_database(root, f, 'hash_store_size')
-                        
-                        if self.hash_name_mode:
-                            self.insert_into_database(root, f, 'hash_store_name')
-
-                    
-            logger.info('Done scanning %s' % root_path)
+        Only files inside the paths are added, if paths are given the database is not truncated.
+        """
+        if paths:
+            logger.info('Just adding new paths from manifests')
+        else:
+            logger.info('Rebuilding database from manifests')
+            self.truncate()
+            paths = self.paths
+        
+        self._rebuild(self._listing_walk_stage(self._manifest_listing(manifest_files), paths), paths)
+    
+    def rebuild_from_client(self, client, paths=None):
+        """
+        Rebuilds the database from the completed files of the torrents in a torrent client
+        instead of scanning the disks.
+        
+        Only files inside the paths are added, if paths are given the database is not truncated.
+        """
+        if paths:
+            logger.info('Just adding new paths from the torrent client')
+        else:
+            logger.info('Rebuilding database from the torrent client')
+            self.truncate()
+            paths = self.paths
+        
+        def listing():
+            logger.info('Getting the files from the torrent client')
+            for torrent_files in client.get_files():
+                for path, size in torrent_files:
+                    yield os.path.abspath(path), FileStat(size, None, None)
+        
+        self._rebuild(self._listing_walk_stage(listing(), paths), paths)
+    
+    def _rebuild(self, walked, paths):
+        """
+        Runs walked folders from paths through the rest of the rebuild pipeline.
+        """
+        walked = threaded_iterator(walked, self.rebuild_queue_size)
+        stated = threaded_iterator(self._stat_stage(self._filter_stage(walked)), self.rebuild_queue_size)
+        self._write_stage(self._key_stage(self._signature_stage(stated, paths)))
+        self.db.sync()
+    
+    def get_scan_modes(self):
+        """
+        Returns a sorted list of the enabled scan modes.
+        """
+        modes = [('normal', self.normal_mode), ('unsplitable', self.unsplitable_mode), ('exact', self.exact_mode),
+                 ('hash_name', self.hash_name_mode), ('hash_size', self.hash_size_mode), ('hash_slow', self.hash_slow_mode)]
+        return sorted(mode for mode, enabled in modes if enabled)
+    
+    def export(self, export_file):
+        """
+        Exports the content of the database to a portable file that can be
+        merged into a database on another machine.
+        
+        The export is a json header followed by a json list of key and value per line.
+        """
+        logger.info('Exporting database to %s' % export_file)
+        with open(export_file, 'wb') as f:
+            header = {'version': EXPORT_VERSION, 'scan_modes': self.get_scan_modes()}
+            if self.size_filter is not None:
+                header['size_filter'] = self.dump_size_filter()
+            f.write(json.dumps(header).encode('utf-8') + b'\n')
+            for key in self.db.keys():
+                if key in (SIZE_FILTER_KEY, GENERATION_KEY, DATABASE_ID_KEY):
+                    continue
+                f.write(json.dumps([key, self.db[key]]).encode('utf-8') + b'\n')
+    
+    def merge(self, export_file, path_rewrite=None):
+        """
+        Merges an export into the database.
+        
+        path_rewrite is an optional (local prefix, mount prefix) pair, paths starting with
+        local prefix in the export are rewritten to start with mount prefix instead.
+        """
+        logger.info('Merging %s into the database' % export_file)
+        def rewrite(path):
+            if path_rewrite:
+                local_prefix = path_rewrite[0].rstrip(os.sep)
+                if path == local_prefix or path.startswith(local_prefix + os.sep):
+                    return path_rewrite[1].rstrip(os.sep) + path[len(local_prefix):]
+            return path
+        
+        with open(export_file, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if header.get('version') != EXPORT_VERSION:
+                raise DatabaseExportException('Unknown export version %r in %s' % (header.get('version'), export_file))
+            
+            if header['scan_modes'] != self.get_scan_modes():
+                logger.warning('%s was exported with scan modes %s but the database uses %s' % (export_file,
+                               ','.join(header['scan_modes']), ','.join(self.get_scan_modes())))
+            
+            if 'size_filter' not in header:
+                self.size_filter = None
+            elif self.size_filter is not None:
+                export_size_filter = BloomFilter(data=base64.b64decode(header['size_filter']))
+                if self.size_filter == set():
+                    self.size_filter = export_size_filter
+                else:
+                    self.build_size_filter()
+                    self.size_filter.update(export_size_filter)
+            
+            self.lookup_cache.clear()
+            for line in f:
+                key, value = json.loads(line.decode('utf-8'))
+                key = str(key)
+                if isinstance(value, list):
+                    old_value = self.db.get(key, [])
+                    self.db[key] = old_value + [rewrite(path) for path in value if rewrite(path) not in old_value]
+                else:
+                    value = rewrite(value)
+                    old_value = self.db.get(key)
+                    if old_value and old_value != value:
+                        logger.warning('Duplicate key %s and %s' % (value, old_value))
+                    self.db[key] = value
+        
+        self.save_size_filter()
+        self.bump_generation()
         self.db.sync()
     
+    def merge_exports(self, exports):
+        """
+        Replaces the content of the database with merged exports.
+        
+        exports is a list of (export file, path_rewrite) pairs, see merge.
+        """
+        self.truncate()
+        for export_file, path_rewrite in exports:
+            self.merge(export_file, path_rewrite)
+    
     def clear_hash_size_table(self):
         """
         Clears the hash size table.
         """
         self.hash_size_table = None
+        self.lookup_cache.clear()
     
     def build_hash_size_table(self):
         """
@@ -205,6 +778,7 @@ class Database(object):
         
         self.hash_size_table = sorted(self.hash_size_table)
     
+    @cached_lookup
     def find_hash_varying_size(self, size):
         """
         Looks for a file with close to size in the database.
@@ -233,6 +807,7 @@ class Database(object):
         
         return result
     
+    @cached_lookup
     def find_hash_size(self, size):
         """
         Looks for a file with exact size in the database.
@@ -241,6 +816,7 @@ class Database(object):
         """
         return self.db.get(str('s:%s' % size), [])
     
+    @cached_lookup
     def find_hash_name(self, f):
         """
         Looks for a file with name f in the database.
@@ -251,15 +827,21 @@ class Database(object):
         
         return self.db.get(key, [])
     
+    def unsplitable_file_path_key(self, rls, f, size):
+        """
+        Creates the key of a file in an unsplitable release.
+        """
+        f = [self.normalize_filename(x) for x in f]
+        return self.keyify(size, self.normalize_filename(rls), *f)
+    
+    @cached_lookup
     def find_unsplitable_file_path(self, rls, f, size):
         """
         Looks for a file in the database.
         """
-        f = [self.normalize_filename(x) for x in f]
-        key = self.keyify(size, self.normalize_filename(rls), *f)
-
-        return self.db.get(key)
+        return self.db.get(self.unsplitable_file_path_key(rls, f, size))
     
+    @cached_lookup
     def find_exact_file_path(self, prefix, rls):
         """
         Looks for a name in the database.
@@ -268,22 +850,119 @@ class Database(object):
 
         return self.db.get(key)
     
+    def _signature(self, entries):
+        """
+        Hashes the entries of a folder into a signature.
+        """
+        return hashlib.sha256('\n'.join(sorted(entries)).encode('utf-8', 'surrogateescape')).hexdigest()
+    
+    def folder_signature(self, files):
+        """
+        Creates the signature of a folder from a list of (path, size) for all files in it,
+        path being a list of folder and file names relative to the folder.
+        
+        The signature is made from the names and sizes of the files and the signatures
+        of the subfolders, so it does not depend on the name of the folder itself.
+        """
+        tree = {}
+        for path, size in files:
+            node = tree
+            for name in path[:-1]:
+                node = node.setdefault(name, {})
+            node[path[-1]] = size
+        
+        def signature(node):
+            entries = []
+            for name, value in node.items():
+                if isinstance(value, dict):
+                    entries.append('%s|d:%s' % (name, signature(value)))
+                else:
+                    entries.append('%s|f:%i' % (name, value))
+            return self._signature(entries)
+        
+        return signature(tree)
+    
+    @cached_lookup
+    def find_folder_path(self, signature):
+        """
+        Looks for folders with a signature in the database.
+        
+        Returns a list of paths.
+        """
+        return self.db.get(str('g:%s' % signature), [])
+    
+    def file_path_key(self, f, size):
+        """
+        Creates the key of a file.
+        """
+        return self.keyify(size, self.normalize_filename(f))
+    
+    @cached_lookup
     def find_file_path(self, f, size):
         """
         Looks for a file in the database.
         """
-        key = self.keyify(size, self.normalize_filename(f))
-
-        return self.db.get(key)
+        return self.db.get(self.file_path_key(f, size))
+    
+    def get_many(self, keys):
+        """
+        Reads many keys from the database.
+        
+        Returns a dict with the value of the keys found.
+        """
+        result = {}
+        for key in keys:
+            value = self.db.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+    
+    def find_many(self, lookups):
+        """
+        Does many find_file_path and find_unsplitable_file_path lookups at once.
+        lookups is a list of (method name, *args) tuples.
+        
+        Every unique lookup is only done once and files with a size that is not
+        in the database are not looked up at all.
+        
+        Returns a list of the results in the same order as lookups.
+        """
+        key_functions = {
+            'find_file_path': self.file_path_key,
+            'find_unsplitable_file_path': self.unsplitable_file_path_key,
+        }
+        
+        lookups = [tuple(tuple(arg) if isinstance(arg, list) else arg for arg in lookup) for lookup in lookups]
+        found = {}
+        lookup_keys = {}
+        for lookup in set(lookups):
+            method, args = lookup[0], lookup[1:]
+            if method not in key_functions:
+                raise ValueError('Unknown lookup %r' % method)
+            
+            value = self.lookup_cache.get(lookup, _missing)
+            if value is not _missing:
+                found[lookup] = value
+            elif not self.has_size(args[-1]):
+                found[lookup] = None
+            else:
+                lookup_keys[lookup] = key_functions[method](*args)
+        
+        values = self.get_many(set(lookup_keys.values()))
+        for lookup, key in lookup_keys.items():
+            found[lookup] = values.get(key)
+            self.lookup_cache.set(lookup, found[lookup])
+        
+        return [found[lookup] for lookup in lookups]
     
     def keyify(self, size, *names):
         """
         Turns a name and size into a key that can be stored in the database.
         """
         key = '%s|%s' % (size, '|'.join(names))
-        logger.debug('Keyify: %s' % key)
+        logger.debug('Keyify: %r' % key)
         
-        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest()
     
     def normalize_filename(self, filename):
         """
@@ -0,0 +1,268 @@
+from __future__ import unicode_literals
+
+import base64
+import json
+import logging
+import os
+import socket
+import threading
+
+from six.moves import socketserver
+
+from .cache import LRUCache
+from .db import Database
+from .utils import BloomFilter
+
+logger = logging.getLogger(__name__)
+
+SERVED_METHODS = [
+    'find_file_path',
+    'find_unsplitable_file_path',
+    'find_exact_file_path',
+    'find_hash_size',
+    'find_hash_name',
+    'find_hash_varying_size',
+    'find_folder_path',
+    'dump_size_filter',
+    'get_many',
+    'find_many',
+    'get_generation',
+    'get_database_id',
+    'get_scan_modes',
+]
+
+class DatabaseServerException(Exception):
+    pass
+
+class DatabaseRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        """
+        Answers newline separated json requests until the client disconnects.
+        """
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = {'result': self.server.call(request['method'], request.get('args', []))}
+            except Exception as e:
+                logger.exception('Failed to handle request %r' % line)
+                response = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class DatabaseServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Keeps a Database open and answers lookups over a unix socket.
+    Only the read-only methods in SERVED_METHODS are answered.
+    """
+    daemon_threads = True
+    
+    def __init__(self, db, socket_path):
+        self.db = db
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        
+        if os.path.exists(socket_path):
+            if RemoteDatabase.is_alive(socket_path):
+                raise DatabaseServerException('A database server is already running on %r' % socket_path)
+            logger.info('Removing stale socket %r' % socket_path)
+            os.remove(socket_path)
+        
+        socketserver.UnixStreamServer.__init__(self, socket_path, DatabaseRequestHandler)
+        
+        if db.hash_slow_mode:
+            logger.info('Slow mode enabled, building hash size table')
+            db.build_hash_size_table()
+    
+    def call(self, method, args):
+        """
+        Calls a database method.
+        """
+        if method == 'ping':
+            return True
+        
+        if method not in SERVED_METHODS:
+            raise DatabaseServerException('Unknown method %r' % method)
+        
+        with self.lock:
+            return getattr(self.db, method)(*args)
+    
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+class RemoteDatabase(Database):
+    """
+    Database that sends all lookups to a DatabaseServer.
+    The scan modes must match the ones the server was started with.
+    
+    The server only answers lookups, the database cannot be changed or exported through it.
+    """
+    
+    def __init__(self, socket_path, paths, ignore_files, normal_mode, unsplitable_mode, exact_mode,
+                 hash_name_mode, hash_size_mode, hash_slow_mode):
+        self.socket_path = socket_path
+        self._set_scan_settings(paths, ignore_files, normal_mode, unsplitable_mode, exact_mode,
+                                hash_name_mode, hash_size_mode, hash_slow_mode)
+        self.size_filter = None
+        self.lookup_cache = LRUCache(0) # the server caches the lookups
+        self._size_filter_loaded = False
+        self._socket = None
+        self._socket_file = None
+    
+    @classmethod
+    def is_alive(cls, socket_path):
+        """
+        Checks if a database server answers on socket_path.
+        """
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(socket_path)
+            s.sendall(json.dumps({'method': 'ping'}).encode('utf-8') + b'\n')
+            return json.loads(s.makefile('rb').readline().decode('utf-8')).get('result') is True
+        except (socket.error, ValueError):
+            return False
+        finally:
+            s.close()
+    
+    def _call(self, method, *args):
+        """
+        Sends a request to the server and returns the result, connecting first if needed.
+        """
+        if self._socket is None:
+            self._connect()
+        
+        return self._send(method, *args)
+    
+    def _connect(self):
+        """
+        Connects to the server and makes sure it was started with the same scan modes,
+        lookups in other modes would find nothing.
+        """
+        logger.debug('Connecting to database server at %r' % self.socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(self.socket_path)
+        self._socket_file = self._socket.makefile('rb')
+        
+        server_scan_modes = self._send('get_scan_modes')
+        if server_scan_modes != self.get_scan_modes():
+            self.close()
+            raise DatabaseServerException('Database server scan modes %s do not match the configured scan modes %s' % (
+                                          ','.join(server_scan_modes), ','.join(self.get_scan_modes())))
+    
+    def _send(self, method, *args):
+        """
+        Sends a request over the open connection and returns the result.
+        """
+        self._socket.sendall(json.dumps({'method': method, 'args': args}).encode('utf-8') + b'\n')
+        line = self._socket_file.readline()
+        if not line:
+            self.close()
+            raise DatabaseServerException('Database server closed the connection')
+        
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise DatabaseServerException(response['error'])
+        
+        return response['result']
+    
+    def open(self, read_only=False):
+        pass # connects on the first request
+    
+    def close(self):
+        """
+        Closes the connection to the server.
+        """
+        if self._socket is not None:
+            self._socket_file.close()
+            self._socket.close()
+            self._socket = self._socket_file = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_socket'] = state['_socket_file'] = None
+        return state
+    
+    def truncate(self):
+        raise DatabaseServerException('The database cannot be truncated through the database server')
+    
+    def load_size_filter(self):
+        data = self._call('dump_size_filter')
+        if data is None:
+            return None
+        
+        return BloomFilter(data=base64.b64decode(data))
+    
+    def fetch_size_filter(self):
+        if not self._size_filter_loaded:
+            self.size_filter = self.load_size_filter()
+            self._size_filter_loaded = True
+    
+    def has_size(self, size):
+        self.fetch_size_filter()
+        return Database.has_size(self, size)
+    
+    def insert_into_database(self, root, f, mode, prefix=None, unsplitable_name=None):
+        raise DatabaseServerException('The database cannot be changed through the database server')
+    
+    def rebuild(self, paths=None):
+        raise DatabaseServerException('The database cannot be rebuilt through the database server')
+    
+    def rebuild_from_manifest(self, manifest_files, paths=None):
+        raise DatabaseServerException('The database cannot be rebuilt through the database server')
+    
+    def rebuild_from_client(self, client, paths=None):
+        raise DatabaseServerException('The database cannot be rebuilt through the database server')
+    
+    def export(self, export_file):
+        raise DatabaseServerException('The database cannot be exported through the database server')
+    
+    def merge(self, export_file, path_rewrite=None):
+        raise DatabaseServerException('Exports cannot be merged through the database server')
+    
+    def merge_exports(self, exports):
+        raise DatabaseServerException('Exports cannot be merged through the database server')
+    
+    def build_hash_size_table(self):
+        pass # the server keeps its own table
+    
+    def clear_hash_size_table(self):
+        pass
+    
+    def find_hash_varying_size(self, size):
+        return self._call('find_hash_varying_size', size)
+    
+    def find_hash_size(self, size):
+        return self._call('find_hash_size', size)
+    
+    def find_hash_name(self, f):
+        return self._call('find_hash_name', f)
+    
+    def find_unsplitable_file_path(self, rls, f, size):
+        return self._call('find_unsplitable_file_path', rls, f, size)
+    
+    def find_exact_file_path(self, prefix, rls):
+        return self._call('find_exact_file_path', prefix, rls)
+    
+    def find_file_path(self, f, size):
+        return self._call('find_file_path', f, size)
+    
+    def find_folder_path(self, signature):
+        return self._call('find_folder_path', signature)
+    
+    def get_many(self, keys):
+        return self._call('get_many', list(keys))
+    
+    def find_many(self, lookups):
+        return self._call('find_many', lookups)
+    
+    def get_generation(self):
+        return self._call('get_generation')
+    
+    def get_database_id(self):
+        return self._call('get_database_id')
@@ -0,0 +1,225 @@
+from __future__ import division
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'copy_range',
+    'reflink',
+    'resize_clone',
+    'write_zeros',
+    'pad_zeros',
+]
+
+CHUNK_SIZE = 65536
+KERNEL_COPY_SIZE = 2**30 # max bytes asked from copy_file_range and sendfile at a time
+
+# ioctls cloning the data of one file into another on copy-on-write filesystems, e.g. btrfs and XFS
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940d
+
+# fallocate modes removing or inserting whole blocks in the middle of a file, e.g. on XFS
+FALLOC_FL_COLLAPSE_RANGE = 0x08
+FALLOC_FL_INSERT_RANGE = 0x20
+
+ZERO_BUFFER = memoryview(bytearray(CHUNK_SIZE))
+
+# errors meaning a copy method does not work for these files and the next one should be tried
+FALLBACK_ERRNOS = set(getattr(errno, name) for name in ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP',
+                                                       'ENOTSUP', 'EBADF', 'ETXTBSY', 'EPERM', 'ENOTTY')
+                      if hasattr(errno, name))
+
+def _write_all(dst_fd, data):
+    while data:
+        written = os.write(dst_fd, data)
+        data = data[written:]
+
+def _load_fallocate():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = libc.fallocate
+    except (AttributeError, OSError, TypeError):
+        logger.debug('fallocate is not available')
+        return None
+    
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+_libc_fallocate = _load_fallocate()
+
+def _fallocate(fd, mode, offset, length):
+    if _libc_fallocate is None:
+        raise OSError(errno.ENOSYS, 'fallocate is not available')
+    
+    if _libc_fallocate(fd, mode, offset, length) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+def _clone_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    block_size = os.fstat(dst_fd).st_blksize
+    if src_offset % block_size or dst_offset % block_size:
+        raise OSError(errno.EINVAL, 'Offsets are not aligned to blocks of %i bytes' % block_size)
+    
+    src_size = os.fstat(src_fd).st_size
+    if src_offset + length >= src_size: # the range may end unaligned at the end of the file
+        length = max(src_size - src_offset, 0)
+        clone_length = 0 # clone until the end of the file
+    else:
+        length = clone_length = length - length % block_size
+    
+    if not length:
+        raise OSError(errno.EINVAL, 'No whole blocks to clone')
+    
+    fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack(str('qQQQ'), src_fd, src_offset, clone_length, dst_offset))
+    dst_size = dst_offset + length
+    if os.fstat(dst_fd).st_size < dst_size:
+        os.ftruncate(dst_fd, dst_size)
+    return length
+
+def _copy_file_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    return os.copy_file_range(src_fd, dst_fd, min(length, KERNEL_COPY_SIZE), src_offset, dst_offset)
+
+def _sendfile(src_fd, dst_fd, src_offset, dst_offset, length):
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    return os.sendfile(dst_fd, src_fd, src_offset, min(length, KERNEL_COPY_SIZE))
+
+def _read_write(src_fd, dst_fd, src_offset, dst_offset, length):
+    os.lseek(src_fd, src_offset, os.SEEK_SET)
+    data = memoryview(os.read(src_fd, min(length, CHUNK_SIZE)))
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    _write_all(dst_fd, data)
+    return len(data)
+
+COPY_METHODS = []
+if fcntl is not None:
+    COPY_METHODS.append(_clone_range)
+if hasattr(os, 'copy_file_range'):
+    COPY_METHODS.append(_copy_file_range)
+if hasattr(os, 'sendfile'):
+    COPY_METHODS.append(_sendfile)
+COPY_METHODS.append(_read_write)
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length, copy_methods=None):
+    """
+    Copies length bytes from src_offset in one file to dst_offset in another, stopping early
+    at the end of the source file. The data is cloned or copied by the kernel when possible, with
+    FICLONERANGE for whole blocks, then copy_file_range, sendfile and at last by reading and writing it.
+    
+    Returns the number of bytes copied.
+    """
+    copy_methods = list(copy_methods or COPY_METHODS)
+    copied = 0
+    while copied < length:
+        try:
+            count = copy_methods[0](src_fd, dst_fd, src_offset + copied, dst_offset + copied, length - copied)
+        except (IOError, OSError) as e:
+            if e.errno not in FALLBACK_ERRNOS or len(copy_methods) == 1:
+                raise
+            logger.debug('Unable to copy with %s (%s), falling back to %s' % (copy_methods[0].__name__, e, copy_methods[1].__name__))
+            copy_methods.pop(0)
+            continue
+        
+        if not count:
+            break
+        copied += count
+    
+    return copied
+
+def write_zeros(dst_fd, dst_offset, length):
+    """
+    Writes length zero bytes at dst_offset in a file.
+    """
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    while length > 0:
+        write_bytes = min(CHUNK_SIZE, length)
+        _write_all(dst_fd, ZERO_BUFFER[:write_bytes])
+        length -= write_bytes
+
+def pad_zeros(dst_fd, dst_offset, length, sparse=True):
+    """
+    Fills length bytes at dst_offset in a file with zeros. When sparse is set, the part
+    past the end of the file is left as a hole by extending the file, costing no writes or space.
+    """
+    if not sparse:
+        write_zeros(dst_fd, dst_offset, length)
+        return
+    
+    size = os.fstat(dst_fd).st_size
+    if dst_offset < size:
+        write_bytes = min(size - dst_offset, length)
+        write_zeros(dst_fd, dst_offset, write_bytes)
+        dst_offset += write_bytes
+        length -= write_bytes
+    
+    if length > 0:
+        os.ftruncate(dst_fd, dst_offset + length)
+
+def reflink(src, dst):
+    """
+    Makes dst a copy-on-write clone of src, sharing its data until either is modified.
+    Raises IOError or OSError if the filesystem does not support it.
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, 'Reflinks are not supported on this platform')
+    
+    with open(src, 'rb') as src_fp:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fp.fileno())
+        except:
+            os.close(dst_fd)
+            os.remove(dst)
+            raise
+        os.close(dst_fd)
+
+def resize_clone(src, dst, modification_action, modification_point, length):
+    """
+    Makes dst a reflink of src with length bytes removed ('remove') or inserted as a hole ('add')
+    at modification_point, only touching the blocks around it.
+    
+    Whole blocks are removed or inserted with fallocate from the block boundary before
+    modification_point, then the bytes between the boundary and modification_point are fixed up.
+    
+    Returns True if dst was made, False if the filesystem or the sizes do not allow it.
+    """
+    if _libc_fallocate is None or fcntl is None:
+        return False
+    
+    try:
+        reflink(src, dst)
+    except (IOError, OSError) as e:
+        logger.debug('Unable to reflink %r: %s' % (src, e))
+        return False
+    
+    try:
+        with open(src, 'rb') as src_fp:
+            with open(dst, 'r+b') as dst_fp:
+                dst_fd = dst_fp.fileno()
+                block_size = os.fstat(dst_fd).st_blksize
+                if length % block_size:
+                    raise OSError(errno.EINVAL, '%i bytes is not a multiple of the block size %i' % (length, block_size))
+                
+                block_point = modification_point - modification_point % block_size
+                mode = FALLOC_FL_COLLAPSE_RANGE if modification_action == 'remove' else FALLOC_FL_INSERT_RANGE
+                _fallocate(dst_fd, mode, block_point, length)
+                copy_range(src_fp.fileno(), dst_fd, block_point, block_point, modification_point - block_point)
+                if modification_action == 'add': # the copied bytes were also moved past the hole
+                    write_zeros(dst_fd, block_point + length, modification_point - block_point)
+    except (IOError, OSError) as e:
+        logger.debug('Unable to %s %i bytes at %i in %r: %s' % (modification_action, length, modification_point, dst, e))
+        os.remove(dst)
+        return False
+    
+    return True
@@ -2,14 +2,18 @@ from __future__ import unicode_literals
 
 import hashlib
 import os
+import pickle
 import shutil
 import tempfile
 
 from io import open
 from unittest import TestCase
 
+from .. import at as at_module
 from ..at import AutoTorrent, Status
+from ..utils import Pieces
 from ..bencode import bdecode, bencode
+from ..cache import LRUCache, MatchCache, PieceHashCache
 from ..db import Database
 
 def create_file(temp_folder, path, size):
@@ -31,6 +35,8 @@ class DummyDatabase(Database):
         self.hash_size_mode = False
         self.hash_slow_mode = False
         self.hash_mode = False
+        self.size_filter = None
+        self.lookup_cache = LRUCache(100)
     
     def truncate(self):
         pass
@@ -42,6 +48,7 @@ class DummyDatabase(Database):
         basename = os.path.basename(f)
         key = self.keyify(size, self.normalize_filename(basename))
         self.db[key] = f
+        self.lookup_cache.clear()
 
 class DummyAutoTorrent(AutoTorrent):
     def __init__(self, *args, **kwargs):
@@ -63,6 +70,7 @@ class DummyClient(object):
         infohash = hashlib.sha1(bencode(torrent[b'info'])).hexdigest()
         self.hashes.add(infohash)
         self.last_destination_path = destination_path
+        self.last_fast_resume = fast_resume
         return True
 
 class TestAutoTorrent(TestCase):
@@ -240,6 +248,134 @@ class TestAutoTorrent(TestCase):
         self.assertFalse(self._check_at_log(Status.FOLDER_EXIST_NOT_SEEDING))
         self.assertTrue(self._check_at_log(Status.ALREADY_SEEDING))
     
+    def test_handle_torrentfile_parses_once(self):
+        for f in self.files:
+            self.db.add_file(f, 11)
+        
+        parsed = []
+        parse_torrent = self.at.parse_torrent
+        def counting_parse_torrent(torrent, files=None):
+            parsed.append(torrent)
+            return parse_torrent(torrent, files)
+        self.at.parse_torrent = counting_parse_torrent
+        
+        self.assertEqual(self.at.handle_torrentfile(self.torrent_file), Status.OK)
+        self.assertEqual(len(parsed), 1)
+        
+        self.at.populate_torrents_seeded()
+        self.assertEqual(self.at.handle_torrentfile(self.torrent_file), Status.ALREADY_SEEDING)
+        self.assertEqual(len(parsed), 1)
+    
+    def test_index_torrents(self):
+        self.db.add_file('file_a.txt', 11)
+        self.db.add_file('file_c.txt', 11)
+        
+        lookups = []
+        find_many = self.db.find_many
+        def counting_find_many(l):
+            lookups.append(l)
+            return find_many(l)
+        self.db.find_many = counting_find_many
+        
+        results = self.at.index_torrents([self.torrent, self.torrent, self.torrent_single])
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(len(lookups[0]), 3) # the single file torrent shares a file with the others
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0]['files'], [{'path': ['file_a.txt'], 'length': 11, 'completed': True, 'actual_path': 'file_a.txt'},
+                                               {'path': ['file_b.txt'], 'length': 11, 'completed': False, 'actual_path': None},
+                                               {'path': ['file_c.txt'], 'length': 11, 'completed': True, 'actual_path': 'file_c.txt'}])
+        self.assertEqual(results[2], self.at.index_torrent(self.torrent_single))
+    
+    def test_handle_torrentfiles(self):
+        for f in self.files:
+            self.db.add_file(f, 11)
+        
+        self.assertEqual(list(self.at.handle_torrentfiles([self.torrent_file, self.torrent_file])),
+                         [Status.OK, Status.FOLDER_EXIST_NOT_SEEDING])
+    
+    def test_handle_torrentfiles_missing(self):
+        for f in self.files:
+            self.db.add_file(f, 11)
+        
+        results = self.at.handle_torrentfiles([self.torrent_file, os.path.join(self._temp_path, 'missing.torrent')])
+        self.assertEqual(next(results), Status.OK)
+        self.assertRaises(IOError, next, results)
+    
+    def test_handle_torrentfiles_jobs(self):
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        self.at.piece_hash_cache = PieceHashCache(os.path.join(self._temp_path, 'piecehashcache'))
+        
+        paths = [os.path.join(self.src, 'Some-Release.torrent'), os.path.join(self._temp_path, 'test_single.torrent'),
+                 os.path.join(self.src, 'Some-Release.torrent')]
+        self.assertEqual(list(self.at.handle_torrentfiles(paths, jobs=2)),
+                         [Status.OK, Status.OK, Status.FOLDER_EXIST_NOT_SEEDING])
+        self.assertEqual(self.at.db.find_file_path('file_a.txt', 11), os.path.join(self.src, 'file_a.txt'))
+    
+    def test_index_worker_settings(self):
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        self.at.hash_check_workers = 7
+        self.at.piece_hash_cache = PieceHashCache(os.path.join(self._temp_path, 'piecehashcache'))
+        self.at.piece_hash_cache.close()
+        self.actual_db.close()
+        
+        db, settings = pickle.loads(pickle.dumps((self.actual_db, self.at.get_index_settings())))
+        at_module._init_index_worker(db, settings, set(), set(), False)
+        worker = at_module._index_worker[0]
+        try:
+            self.assertEqual(worker.hash_check_workers, 7)
+            self.assertTrue(worker.piece_hash_cache.read_only)
+        finally:
+            worker.piece_hash_cache.close()
+            db.close()
+            at_module._index_worker = None
+            self.actual_db.open()
+    
+    def test_match_cache(self):
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        self.at.match_cache = MatchCache(os.path.join(self._temp_path, 'matchcache'))
+        
+        indexed = []
+        index_torrent = self.at.index_torrent
+        def counting_index_torrent(torrent, found=None):
+            indexed.append(torrent)
+            return index_torrent(torrent, found)
+        self.at.index_torrent = counting_index_torrent
+        
+        path = os.path.join(self.src, 'Some-Release.torrent')
+        result = self.at.handle_torrentfile(path, dry_run=True)
+        self.assertEqual(len(indexed), 1)
+        self.assertEqual(self.at.handle_torrentfile(path, dry_run=True), result)
+        self.assertEqual(len(indexed), 1)
+        self.assertEqual(list(self.at.handle_torrentfiles([path], dry_run=True, jobs=2)), [result])
+        self.assertEqual(len(indexed), 1)
+        
+        self.actual_db.rebuild()
+        self.assertEqual(self.at.handle_torrentfile(path, dry_run=True), result)
+        self.assertEqual(len(indexed), 2)
+        
+        self.actual_db.db[str('database_id')] = 'another database with the same generation'
+        self.assertEqual(self.at.handle_torrentfile(path, dry_run=True), result)
+        self.assertEqual(len(indexed), 3)
+        self.at.match_cache.close()
+    
+    def test_handle_torrentfile_verify(self):
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        self.at.verify = True
+        
+        self.assertEqual(self.at.handle_torrentfile(os.path.join(self.src, 'Some-Release.torrent')), Status.OK)
+        self.assertTrue(self.client.last_fast_resume)
+        
+        with open(os.path.join(self.src, 'Some-CD-Release', 'CD1', 'somestuff-1.r00'), 'r+b') as f:
+            f.write(b'x')
+        self.at.verify_jobs = 2
+        self.assertEqual(self.at.handle_torrentfile(os.path.join(self.src, 'Some-CD-Release.torrent')), Status.OK)
+        self.assertFalse(self.client.last_fast_resume)
+        self.assertTrue(os.path.join('CD1', 'somestuff-1.r00') in self.at._printed_messages[-1][2])
+    
     def test_handle_torrentfile_missing_too_many_files(self):
         for f in self.files[:-1]:
             self.db.add_file(f, 11)
@@ -297,6 +433,87 @@ class TestAutoTorrent(TestCase):
         self.at.link_type = 'hard'
         self.test_link_files_soft()
     
+    def test_link_files_folders(self):
+        for link_workers in (1, 4):
+            self.at.link_workers = link_workers
+            destination_path = os.path.join(self.dst, 'workers-%i' % link_workers)
+            self.at.link_files(destination_path, [{
+                'completed': True,
+                'path': ['p', 'sub%i' % (i % 2), 'deeper', os.path.basename(f)],
+                'actual_path': f,
+            } for i, f in enumerate(self.files)])
+            
+            for i, f in enumerate(self.files):
+                self.assertTrue(os.path.isfile(os.path.join(destination_path, 'p', 'sub%i' % (i % 2), 'deeper', os.path.basename(f))))
+    
+    def get_folder_files(self, folder):
+        files = []
+        for root, _, filenames in os.walk(folder):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                files.append({
+                    'completed': True,
+                    'path': ['Some-Release'] + os.path.relpath(path, folder).split(os.sep),
+                    'actual_path': path,
+                })
+        return files
+    
+    def test_link_files_folder(self):
+        source = os.path.join(self.src, 'Some-Release')
+        self.at.link_files(os.path.join(self.dst, 'default'), self.get_folder_files(source))
+        self.assertFalse(os.path.islink(os.path.join(self.dst, 'default', 'Some-Release')))
+        
+        self.at.link_folders = True
+        self.at.link_files(os.path.join(self.dst, 'folder'), self.get_folder_files(source))
+        
+        p = os.path.join(self.dst, 'folder', 'Some-Release')
+        self.assertTrue(os.path.islink(p))
+        self.assertEqual(os.readlink(p), source)
+        
+        self.at.link_folders = False
+        self.at.link_files(os.path.join(self.dst, 'files'), self.get_folder_files(source))
+        self.assertFalse(os.path.islink(os.path.join(self.dst, 'files', 'Some-Release')))
+    
+    def test_list_folder_tree(self):
+        source = os.path.join(self.src, 'Some-Release')
+        found_files = self.at.list_folder_tree(source)
+        self.assertEqual(found_files[os.path.join(source, 'Subs')], set(['some-subs.sfv', 'some-subs.rar']))
+        self.assertTrue(os.path.join('Subs', 'some-subs.rar') in found_files[source])
+        self.assertEqual(len(found_files[source]), 13)
+    
+    def test_link_files_folder_not_exact(self):
+        source = os.path.join(self.src, 'Some-Release')
+        files = self.get_folder_files(source)
+        create_file(self.src, ['Some-Release', 'extra.nfo'], 10)
+        self.at.link_folders = True
+        self.at.link_files(self.dst, files)
+        
+        p = os.path.join(self.dst, 'Some-Release')
+        self.assertFalse(os.path.islink(p))
+        self.assertTrue(os.path.islink(os.path.join(p, 'some-rls.nfo')))
+        self.assertTrue(os.path.islink(os.path.join(p, 'Subs')))
+        self.assertTrue(os.path.islink(os.path.join(p, 'Sample')))
+        for f in files:
+            self.assertTrue(os.path.isfile(os.path.join(self.dst, *f['path'])))
+        self.assertFalse(os.path.exists(os.path.join(p, 'extra.nfo')))
+    
+    def test_link_files_existing(self):
+        files = [{
+            'completed': True,
+            'path': ['p', os.path.basename(f)],
+            'actual_path': f,
+        } for f in self.files]
+        self.at.link_files(self.dst, files)
+        self.assertRaises(OSError, self.at.link_files, self.dst, files)
+    
+    def test_link_files_auto(self):
+        self.at.link_type = 'auto'
+        self.test_link_files_soft()
+        
+        for f in self.files:
+            p = os.path.join(self.dst, 'p', os.path.basename(f))
+            self.assertEqual(os.stat(p).st_ino, os.stat(f).st_ino)
+    
     def test_index_torrent(self):
         self.actual_db.rebuild()
         self.at.db = self.actual_db
@@ -501,6 +718,22 @@ class TestAutoTorrent(TestCase):
         self.assertEqual(self.at.handle_torrentfile(os.path.join(self.src, 'Some-Release.torrent')), Status.OK)
         self.assertEqual(self.client.last_destination_path[len(self._temp_path):].lstrip('/'), 'src/Some-Release')
     
+    def test_folder_signature_renamed_torrent(self):
+        os.rename(os.path.join(self.src, 'Some-Release'), os.path.join(self.src, 'Some-Release-Renamed'))
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        
+        with open(os.path.join(self.src, 'Some-Release.torrent'), 'rb') as f:
+            torrent = bdecode(f.read())
+        
+        result = self.at.index_torrent(torrent)
+        self.assertEqual(result['mode'], 'link')
+        self.assertEqual(len(result['files']), len(torrent[b'info'][b'files']))
+        for f, tf in zip(result['files'], torrent[b'info'][b'files']):
+            self.assertTrue(f['completed'])
+            self.assertEqual(f['path'], [x.decode('utf-8') for x in tf[b'path']])
+            self.assertEqual(f['actual_path'], os.path.join(self.src, 'Some-Release-Renamed', *f['path']))
+    
     def test_link_singlefile_torrent(self):
         self.actual_db.rebuild()
         self.at.db = self.actual_db
@@ -596,8 +829,8 @@ class TestAutoTorrent(TestCase):
             u'completed': True,
             u'length': 11,
             u'path': [u'file_a.txt']},
-           {u'actual_path': None, # can't find the whole file here
-            u'completed': False,
+           {u'actual_path': u'src/file_b.txt', # no whole pieces, found with the pieces shared with file_a and file_c
+            u'completed': True,
             u'length': 11,
             u'path': [u'file_b.txt']},
            {u'actual_path': u'src/file_c.txt',
@@ -607,6 +840,27 @@ class TestAutoTorrent(TestCase):
         
         self.assertEqual(listing, expected_listing)
     
+    def test_index_hash_name_boundary_neighbors(self):
+        self.actual_db.unsplitable_mode = False
+        self.actual_db.normal_mode = False
+        
+        self.actual_db.hash_mode = True
+        self.actual_db.hash_name_mode = True
+        create_file(self.src, ['a', 'file_b.txt'], 11)
+        create_file(self.src, ['z', 'file_b.txt'], 11)
+        self.actual_db.rebuild()
+        self.at.db = self.actual_db
+        
+        result = self.at.index_torrent(self.torrent)
+        listing = result['files']
+        self.assertEqual([f['completed'] for f in listing], [True, True, True])
+        self.assertEqual(listing[1]['actual_path'], os.path.join(self.src, 'file_b.txt'))
+        
+        os.remove(os.path.join(self.src, 'file_a.txt'))
+        self.actual_db.rebuild()
+        result = self.at.index_torrent(self.torrent)
+        self.assertEqual([f['completed'] for f in result['files']], [False, False, True])
+    
     def _align_setup(self):
         self.actual_db.unsplitable_mode = False
         self.actual_db.normal_mode = False
@@ -650,6 +904,49 @@ class TestAutoTorrent(TestCase):
 
         self.assertEqual(listing, expected_listing)
     
+    def test_check_candidates(self):
+        single_torrent, multi_torrent = self._align_setup()
+        pieces = Pieces(multi_torrent)
+        file_a = os.path.join(self.src, 'hashalignment', 'file_a')
+        candidates = [os.path.join(self.src, 'hashalignment', 'file_b'), os.path.join(self.src, 'missing'),
+                      file_a, file_a]
+        
+        for workers in [1, 4]:
+            self.at.hash_check_workers = workers
+            self.assertEqual(self.at.check_candidates(pieces, candidates, 0, 20480), (file_a, True, True))
+            self.assertEqual(self.at.check_candidates(pieces, candidates[:2], 0, 20480), None)
+    
+    def test_plan_candidates(self):
+        hashalignment = os.path.join(self.src, 'hashalignment')
+        create_file(hashalignment, ['file_a.bak'], 20480)
+        create_file(hashalignment, ['other'], 20000)
+        create_file(hashalignment, ['file_c'], 10)
+        os.link(os.path.join(hashalignment, 'file_a'), os.path.join(hashalignment, 'hardlink'))
+        
+        f = {'path': ['file_a'], 'length': 20480}
+        candidates = [os.path.join(hashalignment, name) for name in ['file_c', 'other', 'file_b', 'file_a.bak', 'hardlink',
+                                                                     'file_a', 'missing', 'file_b']]
+        self.assertEqual(self.at.plan_candidates(f, candidates),
+                         [os.path.join(hashalignment, name) for name in ['file_a', 'file_a.bak', 'file_b', 'file_c', 'other']])
+        
+        self.at.hash_check_max_candidates = 2
+        self.assertEqual(len(self.at.plan_candidates(f, candidates)), 2)
+        
+        stat = at_module.os.stat
+        stated = []
+        def counting_stat(path):
+            stated.append(path)
+            return stat(path)
+        
+        many_candidates = [os.path.join(hashalignment, 'missing%i' % i) for i in range(1000)]
+        many_candidates += [os.path.join(hashalignment, name) for name in ['file_a.bak', 'file_a']]
+        at_module.os.stat = counting_stat
+        try:
+            self.assertEqual(self.at.plan_candidates(f, many_candidates), [os.path.join(hashalignment, 'file_a')])
+        finally:
+            at_module.os.stat = stat
+        self.assertEqual(len(stated), 8)
+    
     def test_align_start_add_data(self):
         src = os.path.join(self.src, 'hashalignment', 'file_b')
         with open(src, 'rb') as f:
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from ..cache import LRUCache, MatchCache, PieceHashCache
+from ..utils import Pieces
+
+class TestLRUCache(TestCase):
+    def test_get_set(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+    
+    def test_least_recently_used_dropped(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(len(cache), 2)
+    
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+
+class TestMatchCache(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self._temp_path, 'matchcache')
+    
+    def tearDown(self):
+        if self._temp_path.startswith('/tmp'): # paranoid-mon, the best pokemon.
+            shutil.rmtree(self._temp_path)
+    
+    def test_persisted(self):
+        cache = MatchCache(self.cache_file)
+        self.assertEqual(cache.get('abc', '1:normal'), None)
+        cache.set('abc', '1:normal', {'mode': 'link', 'files': []})
+        cache.close()
+        
+        cache = MatchCache(self.cache_file)
+        self.assertEqual(cache.get('abc', '1:normal'), {'mode': 'link', 'files': []})
+        self.assertEqual(cache.info_hashes('1:normal'), set(['abc']))
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        cache.close()
+    
+    def test_other_version(self):
+        cache = MatchCache(self.cache_file)
+        cache.set('abc', '1:normal', {'mode': 'link', 'files': []})
+        self.assertEqual(cache.get('abc', '2:normal'), None)
+        self.assertEqual(cache.get('abc', '1:normal'), None)
+        cache.close()
+
+class TestPieceHashCache(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self._temp_path, 'piecehashcache')
+        self.data_file = os.path.join(self._temp_path, 'file.bin')
+        with open(self.data_file, 'wb') as f:
+            f.write(b'abcdefghijklmnop')
+    
+    def tearDown(self):
+        if self._temp_path.startswith('/tmp'): # paranoid-mon, the best pokemon.
+            shutil.rmtree(self._temp_path)
+    
+    def test_persisted(self):
+        cache = PieceHashCache(self.cache_file)
+        key = cache.make_key(self.data_file, 4)
+        self.assertEqual(cache.get(key), {})
+        cache.set(key, {0: b'a'})
+        cache.set(key, {4: b'b'})
+        cache.close()
+        
+        cache = PieceHashCache(self.cache_file)
+        self.assertEqual(cache.get(key), {0: b'a', 4: b'b'})
+        self.assertEqual(len(cache), 2)
+        cache.close()
+    
+    def test_not_synced(self):
+        cache = PieceHashCache(self.cache_file)
+        cache.sync_interval = 2
+        cache.set('a', {0: b'a'})
+        cache.set('b', {0: b'b'})
+        cache.set('c', {0: b'c', 4: b'c'})
+        cache.db.sync() # written, but the usage index is not
+        
+        cache = PieceHashCache(self.cache_file, max_hashes=3)
+        self.assertEqual(cache.get('c'), {0: b'c', 4: b'c'})
+        self.assertEqual(len(cache), 4)
+        cache.set('d', {0: b'd'})
+        self.assertEqual(cache.get('a'), {})
+        self.assertEqual(cache.get('b'), {})
+        self.assertEqual(cache.get('c'), {0: b'c', 4: b'c'})
+        cache.close()
+    
+    def test_read_only(self):
+        cache = PieceHashCache(self.cache_file)
+        cache.set('a', {0: b'a'})
+        cache.close()
+        
+        cache = pickle.loads(pickle.dumps(cache))
+        cache.open(read_only=True)
+        cache.set('a', {4: b'a'})
+        self.assertEqual(cache.get('a'), {0: b'a', 4: b'a'})
+        self.assertEqual(cache.pop_new_hashes(), {'a': {4: b'a'}})
+        self.assertEqual(cache.pop_new_hashes(), {})
+        cache.close()
+        
+        cache = PieceHashCache(self.cache_file)
+        self.assertEqual(cache.get('a'), {0: b'a'})
+        cache.close()
+    
+    def test_key_changes(self):
+        key = PieceHashCache.make_key(self.data_file, 4)
+        self.assertNotEqual(key, PieceHashCache.make_key(self.data_file, 8))
+        
+        with open(self.data_file, 'ab') as f:
+            f.write(b'q')
+        self.assertNotEqual(key, PieceHashCache.make_key(self.data_file, 4))
+    
+    def test_least_recently_used_dropped(self):
+        cache = PieceHashCache(self.cache_file, max_hashes=3)
+        cache.set('a', {0: b'a', 4: b'a'})
+        cache.set('b', {0: b'b'})
+        cache.get('a')
+        cache.set('c', {0: b'c'})
+        self.assertEqual(cache.get('b'), {})
+        self.assertEqual(cache.get('a'), {0: b'a', 4: b'a'})
+        self.assertEqual(len(cache), 3)
+        cache.close()
+    
+    def test_evicted_below_max_hashes(self):
+        cache = PieceHashCache(self.cache_file, max_hashes=20)
+        for i in range(20):
+            cache.set(str(i), {0: b'x'})
+        self.assertEqual(len(cache), 20)
+        
+        cache.set('20', {0: b'x'})
+        self.assertEqual(len(cache), 18)
+        self.assertEqual(cache.get('2'), {})
+        self.assertEqual(cache.get('3'), {0: b'x'})
+        cache.close()
+    
+    def test_match_file(self):
+        torrent = {
+            b'info': {
+                b'piece length': 4,
+                b'pieces': b''.join(hashlib.sha1(p).digest() for p in [b'abcd', b'efgh', b'ijkl', b'mnop']),
+            }
+        }
+        cache = PieceHashCache(self.cache_file)
+        pieces = Pieces(torrent, cache)
+        self.assertEqual(pieces.match_file(self.data_file, 0, 16), (True, True))
+        self.assertEqual(pieces.match_file(self.data_file, 0, 16), (True, True))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from unittest import TestCase
+
+import six
+
+from ..cmd import addtfile
+from ..db import Database
+from .test_at import DummyAutoTorrent, DummyClient
+
+class TestAddTorrentFile(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self.src = os.path.join(self._temp_path, 'src')
+        os.makedirs(self.src)
+        
+        dirname = os.path.join(os.path.dirname(__file__), 'testfiles')
+        self.torrents = []
+        for f in ['Some-Release', 'My-DVD']:
+            shutil.copytree(os.path.join(dirname, f), os.path.join(self.src, f))
+            shutil.copy(os.path.join(dirname, f + '.torrent'), os.path.join(self.src, f + '.torrent'))
+            self.torrents.append(f + '.torrent')
+        
+        self.db = Database(os.path.join(self._temp_path, 'db.db'), [self.src], [], True, True, False, False, False, False)
+        self.db.rebuild()
+        self.at = DummyAutoTorrent(self.db, DummyClient(), os.path.join(self._temp_path, 'dst'), 0, 0, False)
+    
+    def tearDown(self):
+        self.db.close()
+        if self._temp_path.startswith('/tmp'): # paranoid-mon, the best pokemon.
+            shutil.rmtree(self._temp_path)
+    
+    def addtfile(self, dry_run):
+        stdout = sys.stdout
+        sys.stdout = six.StringIO()
+        try:
+            addtfile(self.at, self.src, self.torrents, dry_run, False)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+    
+    def test_dry_run_json(self):
+        dry_run_data = json.loads(self.addtfile('json'))
+        self.assertEqual([torrent['torrent'] for torrent in dry_run_data], self.torrents)
+        for torrent in dry_run_data:
+            self.assertEqual(torrent['missing_bytes'], 0)
+            self.assertTrue(torrent['would_add'])
+            self.assertTrue(torrent['local_files'])
+    
+    def test_dry_run_txt(self):
+        output = self.addtfile('txt')
+        for torrent in self.torrents:
+            self.assertTrue('Torrent: %s\n' % torrent in output)
+        self.assertEqual(output.count('Would add: Yes'), len(self.torrents))
+        self.assertTrue(os.path.join(self.src, 'Some-Release', 'some-rls.r01') in output)
+    
+    def test_dry_run_ndjson(self):
+        lines = self.addtfile('ndjson').splitlines()
+        self.assertEqual(len(lines), len(self.torrents))
+        self.assertEqual([json.loads(line)['torrent'] for line in lines], self.torrents)
+        self.assertEqual(json.loads(lines[0]), json.loads(self.addtfile('json'))[0])
@@ -9,7 +9,10 @@ from io import open
 from logging.handlers import BufferingHandler
 from unittest import TestCase
 
-from ..db import Database
+import six
+
+from ..db import Database, read_manifest
+from ..utils import BloomFilter
 
 def create_file(temp_folder, path, size):
     path = os.path.join(temp_folder, *path)
@@ -220,6 +223,265 @@ class TestDatabase(TestCase):
                          sorted([os.path.join(self._temp_path, '3', 'Some-Release', 'Sample', 'some-rls.mkv'),
                           os.path.join(self._temp_path, '3', 'Some-CD-Release', 'Sample', 'some-rls.mkv')]))
 
+    def _write_manifest(self, delimiter):
+        manifest_file = os.path.join(self._temp_path, 'manifest')
+        with open(manifest_file, 'wb') as f:
+            for root, dirs, files in os.walk(self._temp_path):
+                for name in files:
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    f.write(('%i %f %i %s' % (stat.st_size, stat.st_mtime, stat.st_ino, path)).encode('utf-8') + delimiter)
+        return manifest_file
+    
+    def test_read_manifest(self):
+        for delimiter in [b'\n', b'\x00']:
+            manifest_file = self._write_manifest(delimiter)
+            files = dict(read_manifest(manifest_file))
+            path = os.path.join(self._temp_path, '1', 'f', 'c')
+            self.assertEqual(files[path].st_size, 15)
+            self.assertEqual(files[path].st_ino, os.stat(path).st_ino)
+    
+    def test_manifest_latin1_path(self):
+        path = os.path.join(self._temp_path, '2').encode('utf-8') + b'/caf\xe9.txt'
+        with open(path, 'wb') as f:
+            f.write(b'x' * 17)
+        
+        manifest_file = os.path.join(self._temp_path, 'manifest')
+        with open(manifest_file, 'wb') as f:
+            stat = os.stat(path)
+            f.write(('%i %f %i ' % (stat.st_size, stat.st_mtime, stat.st_ino)).encode('utf-8') + path + b'\x00')
+        
+        if six.PY2:
+            name = b'caf\xe9.txt'
+        else:
+            name = os.fsdecode(b'caf\xe9.txt')
+        files = dict(read_manifest(manifest_file))
+        self.assertEqual(files[os.path.join(self._temp_path, '2', name)].st_size, 17)
+        
+        self.db.rebuild_from_manifest([manifest_file])
+        self.assertEqual(self.db.find_file_path(name, 17), os.path.join(self._temp_path, '2', name))
+        
+        self.db.rebuild()
+        self.assertEqual(self.db.find_file_path(name, 17), os.path.join(self._temp_path, '2', name))
+    
+    def test_rebuild_from_manifest(self):
+        manifest_file = self._write_manifest(b'\x00')
+        create_file(self._temp_path, ['2', 'not_in_manifest'], 16)
+        
+        self.db.rebuild_from_manifest([manifest_file])
+        
+        self.test_initial_build()
+        self.test_unsplitable_release_multicd()
+        self.test_exact_release()
+        self.assertEqual(self.db.find_file_path('not_in_manifest', 16), None)
+    
+    def test_rebuild_from_client(self):
+        class DummyClient(object):
+            def __init__(self, paths):
+                self.paths = paths
+            
+            def get_files(self):
+                for root, dirs, files in os.walk(self.paths):
+                    yield [(os.path.join(root, f), os.path.getsize(os.path.join(root, f))) for f in files]
+        
+        create_file(self._temp_path, ['2', 'only_on_disk'], 16)
+        self.db.rebuild_from_client(DummyClient(os.path.join(self._temp_path, '3')))
+        
+        self.assertEqual(self.db.find_file_path('a', 10), None)
+        self.test_unsplitable_release_multicd()
+        self.assertEqual(self.db.find_exact_file_path('d', 'Some-Release'),
+                         [os.path.join(self._temp_path, '3', 'Some-Release')])
+        
+        self.db.rebuild_from_client(DummyClient(self._temp_path), [os.path.join(self._temp_path, '1')])
+        self.assertEqual(self.db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+        self.assertEqual(self.db.find_file_path('only_on_disk', 16), None)
+        self.assertEqual(self.db.find_file_path('d', 12), None)
+    
+    def test_rebuild_from_client_interleaved(self):
+        for p, size in [(['2', 'Pack', 'x.mkv'], 30), (['2', 'Pack', 'Subs', 'x.srt'], 31), (['2', 'Pack', 'y.mkv'], 32)]:
+            create_file(self._temp_path, p, size)
+        
+        def signatures():
+            return dict((key, sorted(self.db.db[key])) for key in self.db.db.keys() if key.startswith('g:'))
+        
+        self.db.rebuild()
+        walk_signatures = signatures()
+        
+        files = []
+        for path in self.db.paths:
+            for root, dirs, fs in os.walk(path):
+                files += [(os.path.join(root, f), os.path.getsize(os.path.join(root, f))) for f in fs]
+        files.sort(key=lambda f: os.path.basename(f[0])) # the files of a folder are not listed together
+        
+        class DummyClient(object):
+            def get_files(client):
+                for f in files:
+                    yield [f]
+        
+        self.db.rebuild_from_client(DummyClient())
+        self.assertEqual(signatures(), walk_signatures)
+        self.assertEqual(self.db.find_folder_path(self.db.folder_signature([(['x.mkv'], 30)])), [])
+        
+        manifest_file = os.path.join(self._temp_path, 'manifest')
+        with open(manifest_file, 'wb') as f:
+            for torrent_files in DummyClient().get_files():
+                for path, size in torrent_files:
+                    f.write(('%i 0 0 %s\n' % (size, path)).encode('utf-8'))
+        
+        self.db.rebuild_from_manifest([manifest_file])
+        self.assertEqual(signatures(), walk_signatures)
+    
+    def test_export_merge(self):
+        export_file = os.path.join(self._temp_path, 'export')
+        self.db.export(export_file)
+        
+        mount_path = os.path.join(self._temp_path, 'mnt')
+        db = Database(os.path.join(self._temp_path, 'merged.db'), [], [], True, True, True, False, False, False)
+        db.merge_exports([(export_file, (self._temp_path, mount_path)),
+                          (export_file, None)])
+        
+        for p, size in self._fs:
+            self.assertEqual(db.find_file_path(p[-1], size), os.path.join(self._temp_path, *p))
+        
+        self.assertEqual(db.find_exact_file_path('d', 'Some-Release'),
+                         [os.path.join(mount_path, '3', 'Some-Release'),
+                          os.path.join(self._temp_path, '3', 'Some-Release')])
+        
+        db.merge_exports([(export_file, (self._temp_path, mount_path))])
+        self.assertEqual(db.find_unsplitable_file_path('Some-Release', ['some-rls.r01'], 12),
+                         os.path.join(mount_path, '3', 'Some-Release', 'some-rls.r01'))
+    
+    def test_export_merge_sibling_prefix(self):
+        create_file(self._temp_path, ['disk1', 'a'], 10)
+        create_file(self._temp_path, ['disk10', 'b'], 11)
+        db = Database(os.path.join(self._temp_path, 'disks.db'), [os.path.join(self._temp_path, 'disk1'),
+                      os.path.join(self._temp_path, 'disk10')], [], True, True, True, False, False, False)
+        db.rebuild()
+        export_file = os.path.join(self._temp_path, 'export')
+        db.export(export_file)
+        
+        mount_path = os.path.join(self._temp_path, 'mnt')
+        merged_db = Database(os.path.join(self._temp_path, 'merged.db'), [], [], True, True, True, False, False, False)
+        merged_db.merge_exports([(export_file, (os.path.join(self._temp_path, 'disk1'), mount_path))])
+        self.assertEqual(merged_db.find_file_path('a', 10), os.path.join(mount_path, 'a'))
+        self.assertEqual(merged_db.find_file_path('b', 11), os.path.join(self._temp_path, 'disk10', 'b'))
+    
+    def test_folder_signature(self):
+        signature = self.db.folder_signature([(['a'], 12), (['c'], 15)])
+        self.assertEqual(self.db.find_folder_path(signature), [os.path.join(self._temp_path, '1', 'f')])
+        
+        self.assertEqual(self.db.folder_signature([(['c'], 15), (['a'], 12)]), signature)
+        self.assertEqual(self.db.find_folder_path(self.db.folder_signature([(['a'], 12), (['c'], 16)])), [])
+        
+        signature = self.db.folder_signature([(['a'], 10), (['b'], 20), (['f', 'a'], 12), (['f', 'c'], 15)])
+        self.assertEqual(self.db.find_folder_path(signature), [])
+        
+        create_file(self._temp_path, ['2', 'g', 'h', 'a'], 12)
+        create_file(self._temp_path, ['2', 'g', 'h', 'c'], 15)
+        create_file(self._temp_path, ['2', 'g', 'i'], 13)
+        self.db.rebuild()
+        
+        signature = self.db.folder_signature([(['a'], 12), (['c'], 15)])
+        self.assertEqual(sorted(self.db.find_folder_path(signature)), [os.path.join(self._temp_path, '1', 'f'),
+                                                                       os.path.join(self._temp_path, '2', 'g', 'h')])
+        
+        signature = self.db.folder_signature([(['i'], 13), (['h', 'a'], 12), (['h', 'c'], 15)])
+        self.assertEqual(self.db.find_folder_path(signature), [os.path.join(self._temp_path, '2', 'g')])
+    
+    def test_size_filter(self):
+        for p, size in self._fs:
+            self.assertTrue(self.db.has_size(size))
+        self.assertFalse(self.db.has_size(16))
+        self.assertEqual(self.db.size_filter.bits, BloomFilter.min_bits) # sized for the few sizes in the database
+        
+        self.db.db.close()
+        db = Database(os.path.join(self._temp_path, 'autotorrent.db'), [], [], True, True, True, False, False, False)
+        self.assertTrue(db.has_size(10))
+        self.assertFalse(db.has_size(16))
+        
+        create_file(self._temp_path, ['2', 'f'], 16)
+        db.rebuild([os.path.join(self._temp_path, '2')])
+        self.assertTrue(db.has_size(16))
+        
+        export_file = os.path.join(self._temp_path, 'export')
+        db.export(export_file)
+        merged_db = Database(os.path.join(self._temp_path, 'merged.db'), [], [], True, True, True, False, False, False)
+        merged_db.merge_exports([(export_file, None)])
+        self.assertTrue(merged_db.has_size(16))
+        self.assertFalse(merged_db.has_size(17))
+        
+        large_export_file = os.path.join(self._temp_path, 'large_export')
+        large_db = Database(os.path.join(self._temp_path, 'large.db'), [], [], True, True, True, False, False, False)
+        large_db.truncate()
+        large_db.size_filter.update(range(1000, 2000))
+        large_db.save_size_filter()
+        large_db.export(large_export_file)
+        merged_db.merge_exports([(export_file, None), (large_export_file, None)])
+        self.assertTrue(merged_db.has_size(16))
+        self.assertTrue(merged_db.has_size(1500))
+    
+    def test_lookup_cache(self):
+        path = os.path.join(self._temp_path, '2', 'd')
+        hits = self.db.lookup_cache.hits
+        self.assertEqual(self.db.find_file_path('d', 12), path)
+        self.assertEqual(self.db.find_file_path('d', 12), path)
+        self.assertEqual(self.db.lookup_cache.hits, hits + 1)
+        
+        self.assertEqual(self.db.find_file_path('g', 16), None)
+        create_file(self._temp_path, ['2', 'g'], 16)
+        self.db.rebuild([os.path.join(self._temp_path, '2')])
+        self.assertEqual(self.db.find_file_path('g', 16), os.path.join(self._temp_path, '2', 'g'))
+        
+        self.db.find_exact_file_path('d', 'Some-Release').append('changed')
+        self.assertEqual(self.db.find_exact_file_path('d', 'Some-Release'),
+                         [os.path.join(self._temp_path, '3', 'Some-Release')])
+    
+    def test_find_many(self):
+        lookups = [('find_file_path', 'a', 10), ('find_file_path', 'a', 11),
+                   ('find_unsplitable_file_path', 'Some-Release', ['some-rls.r01'], 12),
+                   ('find_file_path', 'a', 10)]
+        self.assertEqual(self.db.find_many(lookups), [self.db.find_file_path('a', 10), None,
+                                                      self.db.find_unsplitable_file_path('Some-Release', ['some-rls.r01'], 12),
+                                                      self.db.find_file_path('a', 10)])
+        self.assertRaises(ValueError, self.db.find_many, [('truncate', )])
+    
+    def test_generation(self):
+        generation = self.db.get_generation()
+        self.db.rebuild([os.path.join(self._temp_path, '2')])
+        self.assertTrue(self.db.get_generation() > generation)
+        
+        generation = self.db.get_generation()
+        self.db.rebuild()
+        self.assertTrue(self.db.get_generation() > generation)
+        
+        generation = self.db.get_generation()
+        self.db.find_file_path('a', 10)
+        self.assertEqual(self.db.get_generation(), generation)
+    
+    def test_insert_into_database(self):
+        create_file(self._temp_path, ['2', 'new'], 17)
+        generation = self.db.get_generation()
+        self.assertEqual(self.db.find_file_path('new', 17), None)
+        
+        self.db.insert_into_database(os.path.join(self._temp_path, '2'), 'new', 'normal')
+        self.assertEqual(self.db.find_file_path('new', 17), os.path.join(self._temp_path, '2', 'new'))
+        self.assertEqual(self.db.get_generation(), generation)
+    
+    def test_database_id(self):
+        database_id = self.db.get_database_id()
+        self.assertTrue(database_id)
+        
+        self.db.close()
+        self.db.open()
+        self.assertEqual(self.db.get_database_id(), database_id)
+        
+        self.db.close()
+        for f in os.listdir(self._temp_path):
+            if f.startswith('autotorrent.db'):
+                os.remove(os.path.join(self._temp_path, f))
+        self.db.open()
+        self.assertNotEqual(self.db.get_database_id(), database_id)
+    
     def test_inaccessible_file(self):
         h = TestHandler()
         l = logging.getLogger('autotorrent.db')
@@ -0,0 +1,91 @@
+from __future__ import unicode_literals
+
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+from unittest import TestCase
+
+from ..db import Database
+from ..dbserver import DatabaseServer, DatabaseServerException, RemoteDatabase
+from .test_db import create_file
+
+class TestDatabaseServer(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self._fs = [
+            (['1', 'a'], 10),
+            (['1', 'b'], 20),
+            (['2', 'd'], 12),
+        ]
+        
+        for p, size in self._fs:
+            create_file(self._temp_path, p, size)
+        
+        self.paths = [os.path.join(self._temp_path, '1'), os.path.join(self._temp_path, '2')]
+        self.db = Database(os.path.join(self._temp_path, 'autotorrent.db'), self.paths, [],
+                           True, True, True, False, True, False)
+        self.db.rebuild()
+        
+        self.socket_path = os.path.join(self._temp_path, 'db.socket')
+        self.server = DatabaseServer(self.db, self.socket_path)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        
+        self.remote_db = RemoteDatabase(self.socket_path, self.paths, [],
+                                        True, True, True, False, True, False)
+    
+    def tearDown(self):
+        self.remote_db.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if self._temp_path.startswith('/tmp'): # paranoid-mon, the best pokemon.
+            shutil.rmtree(self._temp_path)
+    
+    def test_is_alive(self):
+        self.assertTrue(RemoteDatabase.is_alive(self.socket_path))
+        self.assertFalse(RemoteDatabase.is_alive(os.path.join(self._temp_path, 'missing.socket')))
+    
+    def test_lookups(self):
+        for p, size in self._fs:
+            self.assertEqual(self.remote_db.find_file_path(p[-1], size), os.path.join(self._temp_path, *p))
+        
+        self.assertEqual(self.remote_db.find_file_path('a', 11), None)
+        self.assertEqual(self.remote_db.find_exact_file_path('f', 'b'), [os.path.join(self._temp_path, '1', 'b')])
+        self.assertEqual(self.remote_db.find_hash_size(12), [os.path.join(self._temp_path, '2', 'd')])
+        self.assertTrue(self.remote_db.has_size(12))
+        self.assertEqual(self.remote_db.find_many([('find_file_path', 'a', 10), ('find_file_path', 'a', 11),
+                                                   ('find_file_path', 'a', 10)]),
+                         [os.path.join(self._temp_path, '1', 'a'), None, os.path.join(self._temp_path, '1', 'a')])
+        self.assertFalse(self.remote_db.has_size(13))
+    
+    def test_read_only(self):
+        export_file = os.path.join(self._temp_path, 'export')
+        self.assertRaises(DatabaseServerException, self.remote_db.rebuild)
+        self.assertRaises(DatabaseServerException, self.remote_db.rebuild_from_manifest, [export_file])
+        self.assertRaises(DatabaseServerException, self.remote_db.merge_exports, [(export_file, None)])
+        self.assertRaises(DatabaseServerException, self.remote_db.export, export_file)
+        
+        for method in ['rebuild', 'export', 'truncate']:
+            self.assertRaises(DatabaseServerException, self.remote_db._call, method, export_file)
+        self.assertFalse(os.path.exists(export_file))
+        self.assertEqual(self.remote_db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+    
+    def test_server_already_running(self):
+        self.assertRaises(DatabaseServerException, DatabaseServer, self.db, self.socket_path)
+    
+    def test_scan_modes_mismatch(self):
+        remote_db = RemoteDatabase(self.socket_path, self.paths, [], True, True, True, True, True, False)
+        self.assertRaises(DatabaseServerException, remote_db.find_file_path, 'a', 10)
+        self.assertEqual(self.remote_db.get_scan_modes(), self.db.get_scan_modes())
+        self.assertEqual(self.remote_db.find_file_path('a', 10), os.path.join(self._temp_path, '1', 'a'))
+    
+    def test_fetch_size_filter(self):
+        self.remote_db.fetch_size_filter()
+        remote_db = pickle.loads(pickle.dumps(self.remote_db))
+        remote_db._call = None # the filter is not fetched again
+        self.assertTrue(remote_db.has_size(12))
+        self.assertFalse(remote_db.has_size(13))
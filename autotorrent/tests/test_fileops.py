@@ -0,0 +1,110 @@
+import errno
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from ..fileops import (copy_range, pad_zeros, reflink, resize_clone, write_zeros, _fallocate, _read_write,
+                       COPY_METHODS, FALLOC_FL_COLLAPSE_RANGE)
+
+class TestFileOps(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self.src = os.path.join(self._temp_path, 'src')
+        self.dst = os.path.join(self._temp_path, 'dst')
+        self.data = os.urandom(200000)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+    
+    def tearDown(self):
+        if self._temp_path.startswith('/tmp'): # paranoid-mon, the best pokemon.
+            shutil.rmtree(self._temp_path)
+    
+    def copy(self, src_offset, dst_offset, length, copy_methods=None):
+        with open(self.src, 'rb') as src_fp:
+            with open(self.dst, 'wb') as dst_fp:
+                copied = copy_range(src_fp.fileno(), dst_fp.fileno(), src_offset, dst_offset, length, copy_methods)
+        
+        with open(self.dst, 'rb') as f:
+            return copied, f.read()
+    
+    def test_copy_range(self):
+        self.assertEqual(self.copy(0, 0, 1000), (1000, self.data[:1000]))
+        self.assertEqual(self.copy(1000, 10, 150000), (150000, b'\x00'*10 + self.data[1000:151000]))
+    
+    def test_copy_range_stops_at_end(self):
+        self.assertEqual(self.copy(150000, 0, 100000), (50000, self.data[150000:]))
+    
+    def test_copy_range_methods(self):
+        for copy_method in COPY_METHODS:
+            self.assertEqual(self.copy(5, 0, 199000, [copy_method, _read_write]), (199000, self.data[5:199005]))
+    
+    def test_copy_range_aligned(self):
+        block_size = os.stat(self.src).st_blksize
+        for copy_method in COPY_METHODS:
+            self.assertEqual(self.copy(block_size, block_size, 150000, [copy_method, _read_write]),
+                             (150000, b'\x00'*block_size + self.data[block_size:block_size+150000]))
+    
+    def test_copy_range_fallback(self):
+        def unsupported(*args):
+            raise OSError(errno.EXDEV, 'Cross-device link')
+        
+        self.assertEqual(self.copy(0, 0, 100000, [unsupported, _read_write]), (100000, self.data[:100000]))
+    
+    def test_write_zeros(self):
+        with open(self.dst, 'wb') as f:
+            f.write(b'abc')
+            f.flush()
+            write_zeros(f.fileno(), 1, 70000)
+        
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), b'a' + b'\x00'*70000)
+    
+    def test_pad_zeros(self):
+        for sparse in (True, False):
+            with open(self.dst, 'wb') as f:
+                f.write(b'abc')
+                f.flush()
+                pad_zeros(f.fileno(), 1, 70000, sparse)
+                os.lseek(f.fileno(), 70001, os.SEEK_SET)
+                os.write(f.fileno(), b'd')
+            
+            with open(self.dst, 'rb') as f:
+                self.assertEqual(f.read(), b'a' + b'\x00'*70000 + b'd')
+    
+    def test_reflink(self):
+        try:
+            reflink(self.src, self.dst)
+        except (IOError, OSError):
+            self.assertFalse(os.path.exists(self.dst))
+            return
+        
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+    
+    def test_collapse_range(self):
+        block_size = os.stat(self.src).st_blksize
+        with open(self.src, 'r+b') as f:
+            try:
+                _fallocate(f.fileno(), FALLOC_FL_COLLAPSE_RANGE, block_size, block_size)
+            except OSError as e:
+                self.skipTest('Collapsing ranges is not supported: %s' % e)
+        
+        with open(self.src, 'rb') as f:
+            self.assertEqual(f.read(), self.data[:block_size] + self.data[block_size*2:])
+    
+    def test_resize_clone(self):
+        block_size = os.stat(self.src).st_blksize
+        expected = {
+            'remove': self.data[:100] + self.data[100+block_size:],
+            'add': self.data[:100] + b'\x00'*block_size + self.data[100:],
+        }
+        for modification_action, data in expected.items():
+            if not resize_clone(self.src, self.dst, modification_action, 100, block_size):
+                self.assertFalse(os.path.exists(self.dst))
+                continue
+            
+            with open(self.dst, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            os.remove(self.dst)
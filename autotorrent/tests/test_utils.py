@@ -1,17 +1,139 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
 from unittest import TestCase
 
-from ..utils import Pieces
+from ..utils import BloomFilter, PieceTable, Pieces, threaded_iterator, verify_pieces
 
 class TestPieces(TestCase):
     def setUp(self):
         self.torrent = {
             b'info': {
                 b'piece length': 4,
-                b'pieces': '\00'*(20*20)
+                b'pieces': b'\00'*(20*20)
             }
         }
         self.pieces = Pieces(self.torrent)
         
     
     def test_get_complete_pieces(self):
-        self.assertEqual(self.pieces.get_complete_pieces(1, 15), (3, 3, ['\00'*(20)]*2))
\ No newline at end of file
+        start_offset, end_offset, pieces = self.pieces.get_complete_pieces(1, 15)
+        self.assertEqual((start_offset, end_offset, list(pieces)), (3, 3, [b'\00'*(20)]*2))
+    
+    def test_get_piece_parts(self):
+        self.assertEqual(self.pieces.get_piece_parts(1, [0, 3, 3, 5, 15]), [(2, 1, 1), (3, 0, 3)])
+        self.assertEqual(self.pieces.get_piece_parts(0, [0, 3, 3, 5, 15]), [(0, 0, 3), (2, 0, 1)])
+        self.assertEqual(self.pieces.get_piece_parts(2, [0, 3, 3, 5, 15]), [(3, 3, 4)])
+        self.assertEqual(self.pieces.get_piece_parts(3, [0, 3, 3, 5, 15]), [(3, 7, 3)])
+
+class TestPieceTable(TestCase):
+    def setUp(self):
+        self.digests = [hashlib.sha1(str(i).encode('ascii')).digest() for i in range(10)]
+        self.table = PieceTable(b''.join(self.digests))
+    
+    def test_access(self):
+        self.assertEqual(len(self.table), 10)
+        self.assertEqual(self.table[3], self.digests[3])
+        self.assertEqual(self.table[-1], self.digests[-1])
+        self.assertEqual(list(self.table[2:5]), self.digests[2:5])
+        self.assertEqual(list(self.table[5:2]), [])
+        self.assertRaises(IndexError, lambda: self.table[10])
+    
+    def test_compare(self):
+        self.assertEqual(self.table.compare(2, self.digests[2:5]), [True] * 3)
+        self.assertEqual(self.table.compare(2, [self.digests[2], b'x'*20, self.digests[4]]), [True, False, True])
+        self.assertEqual(self.table[1:].compare(1, self.digests[2:4]), [True, True])
+    
+    def test_pickle(self):
+        self.assertEqual(list(pickle.loads(pickle.dumps(self.table[4:6]))), self.digests[4:6])
+
+class TestThreadedIterator(TestCase):
+    def test_items_in_order(self):
+        self.assertEqual(list(threaded_iterator(iter(range(100)), 3)), list(range(100)))
+    
+    def test_exception_reraised(self):
+        def failing():
+            yield 1
+            raise ValueError('failed')
+        
+        result = threaded_iterator(failing(), 3)
+        self.assertEqual(next(result), 1)
+        self.assertRaises(ValueError, next, result)
+
+class TestBloomFilter(TestCase):
+    def test_contains(self):
+        f = BloomFilter(bits=2**16)
+        for i in range(0, 1000, 2):
+            f.add(i)
+        
+        for i in range(0, 1000, 2):
+            self.assertTrue(i in f)
+        
+        self.assertTrue(sum(1 for i in range(1, 1000, 2) if i in f) < 10)
+    
+    def test_update(self):
+        f1, f2 = BloomFilter(bits=2**16), BloomFilter(bits=2**16)
+        f1.add(10)
+        f2.add(20)
+        f1.update(BloomFilter(bits=2**16, data=f2.to_bytes()))
+        self.assertTrue(10 in f1)
+        self.assertTrue(20 in f1)
+        self.assertRaises(ValueError, f1.update, BloomFilter(bits=3*2**8))
+        self.assertRaises(ValueError, f1.update, BloomFilter(bits=2**16, hashes=3))
+    
+    def test_update_folds(self):
+        f1, f2 = BloomFilter(bits=2**16), BloomFilter(bits=2**10)
+        f1.add(10)
+        f2.add(20)
+        f1.update(f2)
+        self.assertEqual(f1.bits, 2**10)
+        self.assertTrue(10 in f1)
+        self.assertTrue(20 in f1)
+        
+        f2.update(BloomFilter.from_values([30]))
+        self.assertTrue(30 in f2)
+    
+    def test_from_values(self):
+        self.assertEqual(BloomFilter.from_values([]).bits, BloomFilter.min_bits)
+        
+        f = BloomFilter.from_values(range(0, 20000, 2))
+        self.assertEqual(f.bits, 2**18)
+        self.assertEqual(BloomFilter(data=f.to_bytes()).bits, 2**18)
+        for i in range(0, 20000, 2):
+            self.assertTrue(i in f)
+        self.assertTrue(sum(1 for i in range(1, 20000, 2) if i in f) < 100)
+
+class TestVerifyPieces(TestCase):
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self.files = []
+        data = b''
+        for i, length in enumerate([5, 0, 13, 2, 20]):
+            path = os.path.join(self._temp_path, str(i))
+            content = (chr(ord('a') + i) * length).encode('ascii')
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.files.append((path, length))
+            data += content
+        
+        self.piece_size = 4
+        self.pieces = [hashlib.sha1(data[i:i+self.piece_size]).digest() for i in range(0, len(data), self.piece_size)]
+    
+    def tearDown(self):
+        if self._temp_path.startswith('/tmp'): # paranoid-mon, the best pokemon.
+            shutil.rmtree(self._temp_path)
+    
+    def test_all_match(self):
+        self.assertEqual(verify_pieces(self.files, self.piece_size, self.pieces), [True] * 10)
+        self.assertEqual(verify_pieces(self.files, self.piece_size, self.pieces, jobs=2, pieces_per_job=3), [True] * 10)
+    
+    def test_missing_and_changed(self):
+        self.files[0] = (None, 5)
+        with open(self.files[3][0], 'wb') as f:
+            f.write(b'xx')
+        
+        self.assertEqual(verify_pieces(self.files, self.piece_size, self.pieces, pieces_per_job=3),
+                         [None, None, True, True, False, True, True, True, True, True])
@@ -1,13 +1,26 @@
 from __future__ import division
 
+import bisect
 import hashlib
 import logging
+import multiprocessing
 import os
 import re
+import sys
+import threading
+
+import six
+
+from six.moves import queue
 
 __all__ = [
     'is_unsplitable',
+    'is_scene_folder',
     'get_root_of_unsplitable',
+    'threaded_iterator',
+    'BloomFilter',
+    'verify_pieces',
+    'PieceTable',
     'Pieces',
 ]
 
@@ -38,6 +51,18 @@ def is_unsplitable(files):
     
     return found_unsplitable_extensions or found_magic_file
 
+def is_scene_folder(p):
+    """
+    Checks if a folder name is a folder found inside a release, e.g. cd1, sample or bdmv.
+    """
+    if re.match(r'^(cd[1-9])|(samples?)|(proofs?)|((vob)?sub(title)?s?)$', p, re.IGNORECASE): # scene paths
+        return True
+    
+    if re.match(r'^(bdmv)|(disc\d*)|(video_ts)$', p, re.IGNORECASE): # bluray / dd
+        return True
+    
+    return False
+
 def get_root_of_unsplitable(path):
     """
     Scans a path for the actual scene release name, e.g. skipping cd1 folders.
@@ -49,25 +74,293 @@ def get_root_of_unsplitable(path):
         if not p:
             continue
         
-        if re.match(r'^(cd[1-9])|(samples?)|(proofs?)|((vob)?sub(title)?s?)$', p, re.IGNORECASE): # scene paths
+        if is_scene_folder(p):
             continue
         
-        if re.match(r'^(bdmv)|(disc\d*)|(video_ts)$', p, re.IGNORECASE): # bluray / dd
-            continue
+        return p
+
+def threaded_iterator(iterable, maxsize):
+    """
+    Consumes an iterable in a background thread and yields the items through a queue
+    holding at most maxsize items. This lets two stages of a pipeline run at the same time
+    without buffering more than maxsize items between them.
+    
+    Exceptions raised by the iterable are re-raised in the consuming thread.
+    """
+    q = queue.Queue(maxsize)
+    stopped = threading.Event()
+    
+    def put(item):
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def producer():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+    
+    t = threading.Thread(target=producer)
+    t.daemon = True
+    t.start()
+    
+    try:
+        while True:
+            is_item, item = q.get()
+            if is_item:
+                yield item
+            elif item is None:
+                break
+            else:
+                six.reraise(*item)
+    finally:
+        stopped.set()
+
+class BloomFilter(object):
+    """
+    Compact set of integers that can answer if a value was definitely not added.
+    Values that were added are always found, others are found with a small false positive rate.
+    
+    Filters with the same number of hashes can be combined with update, a filter whose
+    size is a multiple of the other filter's size is folded down to the smaller size first.
+    """
+    min_bits = 2**10
+    bits_per_value = 16 # about 0.25% false positives with 4 hashes
+    
+    def __init__(self, bits=None, hashes=4, data=None):
+        if bits is None:
+            bits = self.min_bits if data is None else len(data) * 8
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            self.data = bytearray(bits // 8)
+        else:
+            self.data = bytearray(data)
+            if len(self.data) * 8 != bits:
+                raise ValueError('Filter data does not have %i bits' % bits)
+    
+    @classmethod
+    def from_values(cls, values, hashes=4):
+        """
+        Creates a filter sized for a collection of distinct values and adds them.
+        The size is a power of two so filters made this way can always be combined.
+        """
+        bits = cls.min_bits
+        while bits < len(values) * cls.bits_per_value:
+            bits *= 2
         
+        bloom_filter = cls(bits, hashes)
+        for value in values:
+            bloom_filter.add(value)
+        return bloom_filter
+    
+    def _positions(self, value):
+        digest = hashlib.md5(str(value).encode('ascii')).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16)
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+    
+    def add(self, value):
+        for position in self._positions(value):
+            self.data[position >> 3] |= 1 << (position & 7)
+    
+    def __contains__(self, value):
+        for position in self._positions(value):
+            if not self.data[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+    
+    def _folded_data(self, bits):
+        """
+        Returns the data of the filter folded down to bits, the positions of a value
+        are the same modulo any size dividing the filter size.
+        """
+        size = bits // 8
+        data = bytearray(self.data[:size])
+        for offset in range(size, len(self.data), size):
+            for i, byte in enumerate(self.data[offset:offset + size]):
+                if byte:
+                    data[i] |= byte
+        return data
+    
+    def update(self, other):
+        """
+        Adds all values of another filter to this filter.
+        """
+        bits = min(self.bits, other.bits)
+        if other.hashes != self.hashes or self.bits % bits or other.bits % bits:
+            raise ValueError('Cannot combine filters with different sizes')
         
-        return p
+        if self.bits != bits:
+            logger.debug('Folding filter of %i bits to %i bits' % (self.bits, bits))
+            self.data = self._folded_data(bits)
+            self.bits = bits
+        
+        for i, byte in enumerate(other._folded_data(bits)):
+            if byte:
+                self.data[i] |= byte
+    
+    def to_bytes(self):
+        return bytes(self.data)
+
+def _verify_piece_range(files, piece_size, pieces, start_piece, end_piece):
+    """
+    Checks the pieces from start_piece to end_piece, reading the files sequentially.
+    See verify_pieces.
+    """
+    file_index, file_offset = 0, start_piece * piece_size
+    while file_index < len(files) and file_offset >= files[file_index][1]:
+        file_offset -= files[file_index][1]
+        file_index += 1
+    
+    result = []
+    f = None
+    try:
+        for piece in pieces[start_piece:end_piece]:
+            h = hashlib.sha1()
+            missing, failed = False, False
+            remaining = piece_size
+            while remaining and file_index < len(files):
+                path, length = files[file_index]
+                to_read = min(remaining, length - file_offset)
+                if path is None:
+                    missing = True
+                else:
+                    if f is None:
+                        try:
+                            f = open(path, 'rb')
+                            f.seek(file_offset)
+                        except (IOError, OSError):
+                            logger.debug('Unable to read %r' % path)
+                            f = None
+                    
+                    if f is None:
+                        failed = True
+                    else:
+                        h.update(f.read(to_read))
+                
+                remaining -= to_read
+                file_offset += to_read
+                if file_offset >= length:
+                    if f is not None:
+                        f.close()
+                        f = None
+                    file_index += 1
+                    file_offset = 0
+            
+            if missing:
+                result.append(None)
+            else:
+                result.append(not failed and h.digest() == piece)
+    finally:
+        if f is not None:
+            f.close()
+    
+    return result
+
+_verify_worker = None
+
+def _init_verify_worker(files, piece_size, pieces):
+    global _verify_worker
+    _verify_worker = (files, piece_size, pieces)
+
+def _verify_piece_range_worker(piece_range):
+    return _verify_piece_range(*(_verify_worker + piece_range))
+
+def verify_pieces(files, piece_size, pieces, jobs=1, pieces_per_job=64):
+    """
+    Checks every piece of a torrent, pieces span the files the same way they do in the torrent.
+    files is a list of (path, length) in torrent order, path is None for missing files.
+    
+    The pieces are checked in ranges of pieces_per_job by a pool of jobs processes,
+    each range is read sequentially.
+    
+    Returns a list with True for each piece that matched, False for each piece that did not
+    and None for each piece that could not be checked because it is part of a missing file.
+    """
+    ranges = [(i, min(i + pieces_per_job, len(pieces))) for i in range(0, len(pieces), pieces_per_job)]
+    if jobs > 1 and len(ranges) > 1:
+        pool = multiprocessing.Pool(jobs, _init_verify_worker, (files, piece_size, pieces))
+        try:
+            results = pool.map(_verify_piece_range_worker, ranges)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = [_verify_piece_range(files, piece_size, pieces, start, end) for start, end in ranges]
+    
+    return [status for result in results for status in result]
+
+class PieceTable(object):
+    """
+    The 20 byte piece hashes of a torrent, read from the pieces string
+    through a memoryview instead of being split into a list.
+    Slicing returns a PieceTable sharing the same data.
+    """
+    HASH_SIZE = 20
+    
+    def __init__(self, pieces):
+        self.view = memoryview(pieces)
+    
+    def __reduce__(self):
+        return (PieceTable, (self.view.tobytes(), ))
+    
+    def __len__(self):
+        return len(self.view) // self.HASH_SIZE
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return PieceTable(self.view[start*self.HASH_SIZE:max(start, stop)*self.HASH_SIZE])
+        
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('piece index out of range')
+        
+        return self.view[index*self.HASH_SIZE:(index+1)*self.HASH_SIZE].tobytes()
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def compare(self, start_index, digests):
+        """
+        Compares a list of digests with the pieces from start_index.
+        All digests are compared at once, each one only if they do not all match.
+        
+        Returns a list of True or False for each digest.
+        """
+        if not digests:
+            return []
+        
+        start = start_index * self.HASH_SIZE
+        end = start + len(digests) * self.HASH_SIZE
+        if start >= 0 and end <= len(self.view) and self.view[start:end] == b''.join(digests):
+            return [True] * len(digests)
+        
+        return [digest == self[start_index + i] for i, digest in enumerate(digests)]
 
 class Pieces(object):
     """
     Can help check if files match the files found in a torrent.
     """
     
-    def __init__(self, torrent):
+    def __init__(self, torrent, hash_cache=None):
         self.piece_size = torrent[b'info'][b'piece length']
-        self.pieces = []
-        for i in range(0, len(torrent[b'info'][b'pieces']), 20):
-            self.pieces.append(torrent[b'info'][b'pieces'][i:i+20])
+        self.hash_cache = hash_cache
+        self.pieces = PieceTable(torrent[b'info'][b'pieces'])
     
     def get_complete_pieces(self, start_size, end_size):
         """
@@ -88,6 +381,73 @@ class Pieces(object):
         logger.debug('Start piece:%i end piece:%i' % (start_piece, end_piece-1))
         return start_offset, end_offset, self.pieces[start_piece:end_piece]
     
+    def get_piece_parts(self, piece_index, offsets):
+        """
+        Finds the parts of the files that make up a piece.
+        offsets is the offset of each file in the torrent followed by the total size, e.g. [0, 3, 5] for two files of 3 and 2 bytes.
+        
+        Returns a list of (file index, offset in file, length).
+        """
+        piece_start = piece_index * self.piece_size
+        piece_end = piece_start + self.piece_size
+        
+        parts = []
+        i = max(bisect.bisect_right(offsets, piece_start) - 1, 0)
+        while i < len(offsets) - 1 and offsets[i] < piece_end:
+            file_start, file_end = offsets[i], offsets[i+1]
+            if file_end > piece_start and file_end > file_start:
+                start = max(piece_start, file_start)
+                parts.append((i, start - file_start, min(piece_end, file_end) - start))
+            i += 1
+        
+        return parts
+    
+    def match_piece(self, piece_index, parts):
+        """
+        Checks if a piece matches a list of (path, offset, length) parts of files.
+        """
+        h = hashlib.sha1()
+        try:
+            for path, offset, length in parts:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    h.update(f.read(length))
+        except (IOError, OSError):
+            logger.debug('Unable to read the parts of piece %i' % piece_index)
+            return False
+        
+        return h.digest() == self.pieces[piece_index]
+    
+    def read_piece_hashes(self, file_path, offsets):
+        """
+        Hashes a piece worth of data at each offset in a file.
+        Hashes found in the hash cache are not read again.
+        
+        Returns a dict of offset to hash.
+        """
+        cache_key, hashes = None, {}
+        if self.hash_cache is not None:
+            cache_key = self.hash_cache.make_key(file_path, self.piece_size)
+            hashes = self.hash_cache.get(cache_key)
+        
+        missing_offsets = sorted(set(offset for offset in offsets if offset not in hashes))
+        if not missing_offsets:
+            logger.debug('All %i pieces of %r were found in the hash cache' % (len(offsets), file_path))
+            return hashes
+        
+        new_hashes = {}
+        with open(file_path, 'rb') as f:
+            for offset in missing_offsets:
+                logger.debug('Hashing piece at %i bytes of %r' % (offset, file_path))
+                f.seek(offset)
+                new_hashes[offset] = hashlib.sha1(f.read(self.piece_size)).digest()
+        
+        if cache_key is not None:
+            self.hash_cache.set(cache_key, new_hashes)
+        
+        hashes.update(new_hashes)
+        return hashes
+    
     def find_piece_breakpoint(self, file_path, start_size, end_size):
         """
         Finds the point where a file with a different size is modified and tries to align it with pieces.
@@ -138,33 +498,13 @@ class Pieces(object):
         
         check_pieces = (len(pieces) // 10) or 1
         
-        match_start, match_end = 0, 0
         size = os.path.getsize(file_path)
-        with open(file_path, 'rb') as f:
-            for i in range(check_pieces): # check from beginning
-                seek_offset = start_offset+self.piece_size*i
-                logger.debug('Checking piece %i from beginning of file, reading from %i bytes. Filesize: %i' % (i, seek_offset, size))
-                f.seek(seek_offset)
-                h = hashlib.sha1(f.read(self.piece_size)).digest()
-                logger.debug('Matching hash %r against %r' % (h, pieces[i]))
-                if h == pieces[i]:
-                    logger.debug('Piece %i matched' % i)
-                    match_start += 1
-                else:
-                    logger.debug('Piece %i did not match' % i)
-            
-            for i in range(check_pieces): # check from end
-                seek_offset = size-end_offset-self.piece_size*(i+1)
-                logger.debug('Checking piece %i from end of file, reading from %i bytes. Filesize: %i' % (i, seek_offset, size))
-                f.seek(seek_offset)
-                h = hashlib.sha1(f.read(self.piece_size)).digest()
-                piece = pieces[(i+1)*-1]
-                logger.debug('Matching hash %r against %r' % (h, piece))
-                if h == piece:
-                    logger.debug('Piece %i matched' % i)
-                    match_end += 1
-                else:
-                    logger.debug('Piece %i did not match' % i)
+        start_offsets = [start_offset+self.piece_size*i for i in range(check_pieces)]
+        end_offsets = [size-end_offset-self.piece_size*(i+1) for i in range(check_pieces)]
+        hashes = self.read_piece_hashes(file_path, start_offsets + end_offsets)
+        
+        match_start = sum(pieces.compare(0, [hashes[offset] for offset in start_offsets]))
+        match_end = sum(pieces.compare(len(pieces) - check_pieces, [hashes[offset] for offset in reversed(end_offsets)]))
         
         logger.debug('Checked %i pieces from both start and end. %i matched from start and %i matched from end.' % (check_pieces, match_start, match_end))
         